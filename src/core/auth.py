@@ -97,7 +97,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> Optional[User
     return user
 
 # websocket用アクセストークン解析
-async def get_current_user_ws(token: str) -> bool:
+async def get_current_user_ws(token: str) -> Users:
     try:
         payload = jwt.decode(token, secret_key)
         uuid: Optional[str] = payload.get("sub")
@@ -108,7 +108,7 @@ async def get_current_user_ws(token: str) -> bool:
     user = await di_injector.get_class(UserRepository).get_user_by_uuid(uuid)
     if user is None:
         credentials_exception(None)
-    return True
+    return user
 
 
 # 解析失敗時の例外
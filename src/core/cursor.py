@@ -0,0 +1,48 @@
+import base64
+from datetime import datetime
+from typing import Optional, Tuple
+
+from fastapi import HTTPException, status
+
+
+def encode_cursor(send_at: datetime, id: int) -> str:
+    """ページングのカーソルを作る
+
+    (送信日時, ID)をマイクロ秒まで含めてURLセーフな文字列にする。クライアントは中身を解釈しない。
+
+    Args:
+        send_at (datetime): 最後に返した行の送信日時
+        id (int): 最後に返した行のID
+
+    Returns:
+        str: カーソル
+    """
+    raw = f"{send_at.isoformat()}|{id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, allow_legacy: bool = True) -> Tuple[datetime, Optional[int]]:
+    """カーソルを(送信日時, ID)に戻す
+
+    移行期間中は従来の秒単位のtimestamp(数字のみ)も受け付ける。その場合IDはNoneになる。
+
+    Args:
+        cursor (str): カーソル
+        allow_legacy (bool): 従来のtimestampのカーソルを受け付けるかどうか(Falseの場合は不正なカーソルとして扱う)
+
+    Returns:
+        Tuple[datetime, int | None]: (送信日時, ID)
+    """
+    try:
+        if cursor.isdigit():
+            if not allow_legacy:
+                raise ValueError(cursor)
+            return datetime.fromtimestamp(int(cursor)), None
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        send_at, id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(send_at), int(id)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="カーソルが不正です。",
+        )
@@ -0,0 +1,79 @@
+import asyncio
+import os
+from typing import Awaitable, Callable, Generic, List, Optional, Tuple, TypeVar
+
+# 最初の書き込みからまとめて書き込むまでの最大時間(秒)
+group_commit_window = float(os.getenv("GROUP_COMMIT_WINDOW", "0.005"))
+# 1度にまとめて書き込む最大件数
+group_commit_max_size = int(os.getenv("GROUP_COMMIT_MAX_SIZE", "100"))
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+class GroupCommitBuffer(Generic[T, R]):
+    """同時に届いた書き込みをまとめて1つのトランザクションで書き込む
+
+    最初の書き込みからwindowが経つか、max_size件溜まった時点でまとめてwriteに渡す。
+    writeは渡された順に書き込み、同じ順で結果を返すこと。
+    書き込みは同時に1つだけ行い、書き込み中に届いたものは終わり次第まとめて書き込むため、到着順が保たれる。
+    """
+
+    def __init__(
+        self,
+        write: Callable[[List[T]], Awaitable[List[R]]],
+        window: float = group_commit_window,
+        max_size: int = group_commit_max_size,
+    ):
+        self.write = write
+        self.window = window
+        self.max_size = max_size
+        self.pending: List[Tuple[T, asyncio.Future]] = []
+        self.writing = False
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def submit(self, item: T) -> R:
+        """書き込みを依頼し、まとめて書き込まれた後に自分の結果を受け取る
+
+        Args:
+            item (T): 書き込む内容
+
+        Returns:
+            R: 書き込み結果(書き込みに失敗した場合はまとめた全員に同じ例外を送出する)
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((item, future))
+        if not self.writing:
+            if len(self.pending) >= self.max_size:
+                self._flush()
+            elif self._timer is None:
+                self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.writing or not self.pending:
+            return
+        batch, self.pending = self.pending[:self.max_size], self.pending[self.max_size:]
+        self.writing = True
+        self._task = asyncio.create_task(self._write(batch))
+
+    async def _write(self, batch: List[Tuple[T, asyncio.Future]]):
+        try:
+            results = await self.write([item for item, _ in batch])
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.writing = False
+            # 書き込み中に届いたものは既に待たされているのですぐに書き込む
+            if self.pending:
+                self._flush()
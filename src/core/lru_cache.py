@@ -0,0 +1,63 @@
+import time
+from collections import OrderedDict
+from typing import Generic, Hashable, Optional, Tuple, TypeVar
+
+T = TypeVar('T')
+
+
+class LRUCache(Generic[T]):
+    """プロセス内のLRUキャッシュ
+
+    上限を超えた場合は最も長く参照されていないものから捨てる。
+    ttlを指定した場合は、入れてからttl秒経ったものを無いものとして扱う。
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # キー -> (期限(time.monotonic), 値)
+        self.items: "OrderedDict[Hashable, Tuple[Optional[float], T]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def get(self, key: Hashable) -> Optional[T]:
+        """キャッシュから取得する(なければNone)
+
+        Args:
+            key (Hashable): キー
+        """
+        item = self.items.get(key)
+        if item is None or (item[0] is not None and item[0] <= time.monotonic()):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.items.move_to_end(key)
+        return item[1]
+
+    def put(self, key: Hashable, value: T):
+        """キャッシュに入れる
+
+        Args:
+            key (Hashable): キー
+            value (T): 値
+        """
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        self.items[key] = (expires_at, value)
+        self.items.move_to_end(key)
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def discard(self, key: Hashable):
+        """キャッシュから取り除く
+
+        Args:
+            key (Hashable): キー
+        """
+        self.items.pop(key, None)
+
+    def stats(self) -> dict:
+        """件数とヒット数を返す"""
+        return {"size": len(self.items), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,65 @@
+import unicodedata
+from typing import List
+
+# 検索結果の前後に表示する文字数
+SNIPPET_MARGIN = 30
+
+
+def normalize(text: str) -> str:
+    """検索用に正規化する(全角英数・半角カナの統一と小文字化)
+
+    Args:
+        text (str): 文字列
+
+    Returns:
+        str: 正規化した文字列
+    """
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+def terms(keyword: str) -> List[str]:
+    """検索キーワードを空白区切りの語に分ける(正規化済み・重複なし)
+
+    Args:
+        keyword (str): 検索キーワード
+
+    Returns:
+        List[str]: 語
+    """
+    return list(dict.fromkeys(normalize(keyword).split()))
+
+
+def bigrams(text: str) -> List[str]:
+    """文字列を2文字ずつのngramに分ける(正規化済み・重複なし・空白をまたぐものは含まない)
+
+    Args:
+        text (str): 文字列
+
+    Returns:
+        List[str]: ngram(1文字の語は含まない)
+    """
+    grams = {}
+    for word in normalize(text).split():
+        for index in range(len(word) - 1):
+            grams[word[index:index + 2]] = None
+    return list(grams)
+
+
+def snippet(body: str, words: List[str], margin: int = SNIPPET_MARGIN) -> str:
+    """本文のうち最初に語が現れた位置の前後を切り出す
+
+    Args:
+        body (str): 本文
+        words (List[str]): termsで分けた語
+        margin (int): 前後に含める文字数
+
+    Returns:
+        str: 切り出した本文(省略した側に…を付ける)
+    """
+    text = normalize(body)
+    # 正規化で文字数が変わる場合は位置が合わないため先頭から切り出す
+    positions = [text.find(word) for word in words] if len(text) == len(body) else []
+    found = [position for position in positions if position >= 0]
+    start = max(min(found) - margin, 0) if found else 0
+    end = min(start + margin * 2 + max(len(word) for word in words), len(body)) if words else len(body)
+    return ("…" if start > 0 else "") + body[start:end] + ("…" if end < len(body) else "")
@@ -0,0 +1,253 @@
+import asyncio
+import json
+import os
+import socket
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Set
+
+from src.core.logging import log, log_error
+
+# 配信基盤の種類 memory:プロセス内のみ local_socket:同一ホストのワーカー間で共有
+ws_backplane = os.getenv("WS_BACKPLANE", "memory")
+# local_socket利用時にワーカーごとのソケットを置くディレクトリ
+ws_backplane_dir = os.getenv("WS_BACKPLANE_DIR", "/tmp/anser_now_ws")
+# 他ワーカーのソケット一覧を再取得する間隔(秒)
+ws_backplane_peer_refresh = float(os.getenv("WS_BACKPLANE_PEER_REFRESH", "1"))
+# 受信側のバッファが空くのを待つ時間(秒) 過ぎた場合はそのワーカーへの配信を諦める
+ws_backplane_send_timeout = float(os.getenv("WS_BACKPLANE_SEND_TIMEOUT", "1"))
+
+Handler = Callable[[dict], None]
+
+
+class Backplane(ABC):
+    """WebSocket配信基盤のインターフェース
+
+    配信はチャンネル(一覧用・部屋ごと)単位で行い、購読しているハンドラーにだけ届ける。
+    """
+
+    def __init__(self):
+        self.handlers: Dict[str, Set[Handler]] = {}
+        # 他ワーカーからの配信に抜けがあった時に呼ぶ関数
+        self.gap_handlers: List[Callable[[], None]] = []
+        self.counters: Dict[str, int] = {"published": 0, "dropped": 0, "gaps": 0}
+
+    def subscribe(self, channel: str, handler: Handler):
+        """チャンネルを購読する
+
+        Args:
+            channel (str): チャンネル
+            handler (Handler): 受信時に呼ばれる関数
+        """
+        self.handlers.setdefault(channel, set()).add(handler)
+
+    def unsubscribe(self, channel: str, handler: Handler):
+        """チャンネルの購読をやめる
+
+        Args:
+            channel (str): チャンネル
+            handler (Handler): subscribe時に渡した関数
+        """
+        handlers = self.handlers.get(channel)
+        if handlers is None:
+            return
+        handlers.discard(handler)
+        if not handlers:
+            del self.handlers[channel]
+
+    def on_gap(self, handler: Callable[[], None]):
+        """他ワーカーからの配信の抜けを検知した時に呼ぶ関数を登録する(抜けた内容は分からない)
+
+        Args:
+            handler (Callable[[], None]): 抜けを検知した時に呼ばれる関数
+        """
+        self.gap_handlers.append(handler)
+
+    def stats(self) -> dict:
+        """配信数と、他ワーカーへの配信を諦めた数・受信の抜けを検知した数を返す"""
+        return dict(self.counters)
+
+    def _gap(self):
+        self.counters["gaps"] += 1
+        for handler in self.gap_handlers:
+            try:
+                handler()
+            except Exception as e:
+                log_error(e)
+
+    def dispatch(self, channel: str, message: dict):
+        """このプロセスで購読しているハンドラーに配信する
+
+        Args:
+            channel (str): チャンネル
+            message (dict): 送信内容
+        """
+        for handler in list(self.handlers.get(channel, ())):
+            try:
+                handler(message)
+            except Exception as e:
+                log_error(e)
+
+    @abstractmethod
+    async def start(self):
+        pass
+
+    @abstractmethod
+    async def publish(self, channel: str, message: dict):
+        pass
+
+    @abstractmethod
+    async def close(self):
+        pass
+
+
+class InMemoryBackplane(Backplane):
+    """プロセス内だけで配信する(ワーカー1つの場合)"""
+
+    async def start(self):
+        pass
+
+    async def publish(self, channel: str, message: dict):
+        self.counters["published"] += 1
+        self.dispatch(channel, message)
+
+    async def close(self):
+        self.handlers.clear()
+
+
+class LocalSocketBackplane(Backplane):
+    """Unixドメインソケットで同一ホストの全ワーカーに配信する
+
+    ワーカーごとに{ws_backplane_dir}/{pid}.sockをバインドし、
+    配信時はディレクトリ内の他ワーカーのソケットへデータグラムを送る。
+    受信側は購読しているチャンネル(接続のある部屋)のメッセージだけを処理する。
+    受信側のバッファが溢れている場合は空くまで待ち(同じワーカーへは配信した順に送る)、
+    send_timeoutを過ぎたら諦める。データグラムには送信元ごとの連番を付け、受信側は連番の抜けで取りこぼしを検知する。
+    """
+
+    def __init__(self, directory: str = ws_backplane_dir):
+        super().__init__()
+        self.directory = directory
+        self.path = os.path.join(directory, f"{os.getpid()}.sock")
+        self.sock: socket.socket | None = None
+        self.peers: List[str] = []
+        self.peers_loaded_at = 0.0
+        self._lock = asyncio.Lock()
+        # 送信先ごとのロック(同じ送信先へのデータグラムの順序を保つ)
+        self.peer_locks: Dict[str, asyncio.Lock] = {}
+        # 送信を諦めた送信先(バッファが空くまでは待たずに諦め、1度でも送れたら元に戻す)
+        self.stalled: Set[str] = set()
+        self.sequence = 0
+        # 送信元(pid) -> 最後に受け取った連番
+        self.received: Dict[int, int] = {}
+
+    async def start(self):
+        if self.sock is not None:
+            return
+        async with self._lock:
+            if self.sock is not None:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            sock.bind(self.path)
+            asyncio.get_running_loop().add_reader(sock.fileno(), self._on_readable)
+            self.sock = sock
+
+    async def publish(self, channel: str, message: dict):
+        await self.start()
+        self.counters["published"] += 1
+        self.dispatch(channel, message)
+        self.sequence += 1
+        data = json.dumps(
+            {"s": os.getpid(), "n": self.sequence, "c": channel, "m": message},
+            separators=(",", ":"),
+            ensure_ascii=False,
+        ).encode()
+        await asyncio.gather(*[self._send(peer, data) for peer in self._get_peers()])
+
+    async def _send(self, peer: str, data: bytes):
+        lock = self.peer_locks.setdefault(peer, asyncio.Lock())
+        async with lock:
+            try:
+                if peer in self.stalled:
+                    self.sock.sendto(data, peer)
+                    self.stalled.discard(peer)
+                else:
+                    await asyncio.wait_for(
+                        asyncio.get_running_loop().sock_sendto(self.sock, data, peer),
+                        ws_backplane_send_timeout,
+                    )
+            except (ConnectionRefusedError, FileNotFoundError):
+                # 終了したワーカーのソケットが残っている
+                self._remove_peer(peer)
+            except (asyncio.TimeoutError, OSError) as e:
+                # 受信側は次に届いたデータグラムの連番で抜けを検知する。他のワーカーへの配信は続ける
+                self.counters["dropped"] += 1
+                if peer not in self.stalled:
+                    self.stalled.add(peer)
+                    log(f"backplane send to {peer} failed: {e!r}")
+
+    async def close(self):
+        if self.sock is None:
+            return
+        asyncio.get_running_loop().remove_reader(self.sock.fileno())
+        self.sock.close()
+        self.sock = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _get_peers(self) -> List[str]:
+        now = time.monotonic()
+        if now - self.peers_loaded_at >= ws_backplane_peer_refresh:
+            self.peers = [
+                os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name.endswith(".sock") and os.path.join(self.directory, name) != self.path
+            ]
+            self.peers_loaded_at = now
+        return self.peers
+
+    def _remove_peer(self, peer: str):
+        if peer in self.peers:
+            self.peers.remove(peer)
+        self.peer_locks.pop(peer, None)
+        self.stalled.discard(peer)
+        try:
+            os.unlink(peer)
+        except OSError:
+            pass
+
+    def _on_readable(self):
+        while True:
+            try:
+                data = self.sock.recv(65536 * 4)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                log_error(e)
+                return
+            try:
+                envelope = json.loads(data)
+            except ValueError as e:
+                log_error(e)
+                continue
+            last = self.received.get(envelope["s"])
+            self.received[envelope["s"]] = envelope["n"]
+            # 連番が戻った場合は送信元が再起動している
+            if last is not None and envelope["n"] > last + 1:
+                self._gap()
+            self.dispatch(envelope["c"], envelope["m"])
+
+
+def create_backplane() -> Backplane:
+    """環境変数WS_BACKPLANEに応じた配信基盤を作成する"""
+    if ws_backplane == "memory":
+        return InMemoryBackplane()
+    if ws_backplane == "local_socket":
+        return LocalSocketBackplane()
+    raise ValueError(f"WS_BACKPLANEの値が不正です: {ws_backplane}")
+
+backplane = create_backplane()
@@ -0,0 +1,65 @@
+import asyncio
+import os
+from typing import Callable, Dict, List
+
+# バッチ配信でメッセージを溜める最大時間(秒)
+ws_batch_interval = float(os.getenv("WS_BATCH_INTERVAL", "0.05"))
+# 1フレームにまとめる最大メッセージ数
+ws_batch_max_size = int(os.getenv("WS_BATCH_MAX_SIZE", "20"))
+
+Flush = Callable[[str, List[dict]], None]
+
+
+class MessageBatcher:
+    """部屋ごとのメッセージのまとめ送り
+
+    部屋の最初のメッセージからintervalが経つか、max_size件溜まった時点でまとめてflushに渡す。
+    タイマーは溜まっている部屋ごとに1つだけで、接続数には依存しない。
+    """
+
+    def __init__(self, flush: Flush, interval: float = ws_batch_interval, max_size: int = ws_batch_max_size):
+        self.flush = flush
+        self.interval = interval
+        self.max_size = max_size
+        self.pending: Dict[str, List[dict]] = {}
+        self.timers: Dict[str, asyncio.TimerHandle] = {}
+
+    def add(self, chat_uuid: str, data: dict):
+        """メッセージを溜める
+
+        Args:
+            chat_uuid (str): 部屋ID
+            data (dict): 送信内容
+        """
+        items = self.pending.setdefault(chat_uuid, [])
+        items.append(data)
+        if len(items) >= self.max_size:
+            self.flush_room(chat_uuid)
+        elif chat_uuid not in self.timers:
+            self.timers[chat_uuid] = asyncio.get_running_loop().call_later(
+                self.interval, self.flush_room, chat_uuid
+            )
+
+    def flush_room(self, chat_uuid: str):
+        """部屋に溜まっているメッセージを送る
+
+        Args:
+            chat_uuid (str): 部屋ID
+        """
+        timer = self.timers.pop(chat_uuid, None)
+        if timer is not None:
+            timer.cancel()
+        items = self.pending.pop(chat_uuid, None)
+        if items:
+            self.flush(chat_uuid, items)
+
+    def discard(self, chat_uuid: str):
+        """部屋に溜まっているメッセージを破棄する(部屋の接続がなくなった時)
+
+        Args:
+            chat_uuid (str): 部屋ID
+        """
+        timer = self.timers.pop(chat_uuid, None)
+        if timer is not None:
+            timer.cancel()
+        self.pending.pop(chat_uuid, None)
@@ -0,0 +1,229 @@
+import json
+import os
+import struct
+import zlib
+from typing import Any, Dict, Optional, Tuple, Union
+from fastapi import WebSocket
+
+from src.schema.response.chat_response import ChatIndexResponse
+
+
+# 圧縮付きサブプロトコルを受け付けるかどうか
+ws_compression = os.getenv("WS_COMPRESSION", "1") == "1"
+# この大きさ(バイト)未満のフレームは圧縮しない
+ws_compression_min_size = int(os.getenv("WS_COMPRESSION_MIN_SIZE", "512"))
+# zlibの圧縮レベル
+ws_compression_level = int(os.getenv("WS_COMPRESSION_LEVEL", "6"))
+
+
+class WireFormat:
+    """WebSocketの送信形式
+
+    クライアントはSec-WebSocket-Protocolヘッダーで形式を選ぶ。指定がなければJSON。
+    "+deflate"付きの形式では全フレームをバイナリで送り、先頭1バイトで圧縮の有無を示す。
+    (0x00: 以降はそのまま 0x01: 以降はraw deflate)
+    """
+    JSON = "json"
+    MSGPACK = "msgpack"
+    DEFLATE = "+deflate"
+
+    # サブプロトコル名 -> 送信形式(クライアントが複数指定した場合は先頭から優先)
+    SUBPROTOCOLS = {
+        "anser.msgpack+deflate": MSGPACK + DEFLATE,
+        "anser.json+deflate": JSON + DEFLATE,
+        "anser.msgpack": MSGPACK,
+        "anser.json": JSON,
+    }
+
+
+def negotiate_wire_format(websocket: WebSocket, allow_compression: bool = False) -> Tuple[str, Optional[str]]:
+    """クライアントが指定したサブプロトコルから送信形式を決める
+
+    Args:
+        websocket (WebSocket): WebSocket
+        allow_compression (bool): 圧縮付きの形式を受け付けるかどうか
+
+    Returns:
+        Tuple[str, str | None]: (送信形式, acceptで返すサブプロトコル)
+    """
+    for subprotocol in websocket.scope.get("subprotocols", []):
+        wire_format = WireFormat.SUBPROTOCOLS.get(subprotocol)
+        if wire_format is None:
+            continue
+        if wire_format.endswith(WireFormat.DEFLATE) and not (allow_compression and ws_compression):
+            continue
+        return wire_format, subprotocol
+    return WireFormat.JSON, None
+
+
+def compress(data: bytes) -> bytes:
+    """しきい値以上の大きさのフレームだけraw deflateで圧縮する
+
+    Args:
+        data (bytes): エンコード済みの送信内容
+
+    Returns:
+        bytes: 先頭1バイトに圧縮の有無を付けた送信内容
+    """
+    if len(data) < ws_compression_min_size:
+        return b"\x00" + data
+    compressor = zlib.compressobj(ws_compression_level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    if len(compressed) >= len(data):
+        return b"\x00" + data
+    return b"\x01" + compressed
+
+
+class FrameKind:
+    """フレームの種類(msgpack形式では先頭要素のタグになる)"""
+    OTHER = 0  # input・pingなどスキーマを持たないもの {map}
+    MESSAGE = 1  # チャットメッセージ ChatShowResponseItem
+    INDEX = 2  # チャット一覧 ChatIndexResponseItem
+    BATCH = 3  # チャットメッセージの配列
+
+
+# msgpack形式の項目順(JSONのキーは送らない)
+MESSAGE_FIELDS = ("uuid", "body", "send_at", "sender", "user")
+# userはメッセージごとに繰り返されるため、表示に必要な項目だけ送る
+MESSAGE_USER_FIELDS = ("id", "uuid", "account_name")
+INDEX_FIELDS = tuple(ChatIndexResponse.ChatIndexResponseItem.model_fields)
+
+
+class Frame:
+    """配信するフレーム
+
+    送信形式ごとのエンコード・圧縮結果をキャッシュし、同じ形式の接続には同じものを使い回す。
+    """
+    __slots__ = ("kind", "data", "_encoded")
+
+    def __init__(self, kind: int, data: Any):
+        self.kind = kind
+        self.data = data
+        self._encoded: Dict[str, Union[str, bytes]] = {}
+
+    def encode(self, wire_format: str) -> Union[str, bytes]:
+        """送信形式にエンコードする(形式ごとに1度だけ)
+
+        Args:
+            wire_format (str): 送信形式
+
+        Returns:
+            str | bytes: JSONはテキストフレーム、msgpack・圧縮付きはバイナリフレーム
+        """
+        encoded = self._encoded.get(wire_format)
+        if encoded is None:
+            if wire_format.endswith(WireFormat.DEFLATE):
+                raw = self.encode(wire_format[:-len(WireFormat.DEFLATE)])
+                encoded = compress(raw if isinstance(raw, bytes) else raw.encode())
+            elif wire_format == WireFormat.MSGPACK:
+                encoded = packb(self._compact())
+            else:
+                encoded = json.dumps(self.data, separators=(",", ":"), ensure_ascii=False)
+            self._encoded[wire_format] = encoded
+        return encoded
+
+    def _compact(self) -> list:
+        if self.kind == FrameKind.MESSAGE:
+            return [FrameKind.MESSAGE, *_compact_message(self.data)]
+        if self.kind == FrameKind.INDEX:
+            return [FrameKind.INDEX, *(self.data.get(field) for field in INDEX_FIELDS)]
+        if self.kind == FrameKind.BATCH:
+            return [FrameKind.BATCH, [_compact_message(item) for item in self.data]]
+        return [FrameKind.OTHER, self.data]
+
+
+def _compact_message(data: dict) -> list:
+    values = [data.get(field) for field in MESSAGE_FIELDS]
+    user = data.get("user")
+    values[-1] = [user.get(field) for field in MESSAGE_USER_FIELDS] if user else None
+    return values
+
+
+def packb(value: Any) -> bytes:
+    """MessagePack形式にエンコードする
+
+    送信に必要なnil・bool・int・float・str・bytes・list・dictのみ対応する。
+
+    Args:
+        value (Any): エンコードする値
+
+    Returns:
+        bytes: エンコード結果
+    """
+    buffer = bytearray()
+    _pack(value, buffer)
+    return bytes(buffer)
+
+
+def _pack(value: Any, buffer: bytearray):
+    if value is None:
+        buffer.append(0xc0)
+    elif value is True:
+        buffer.append(0xc3)
+    elif value is False:
+        buffer.append(0xc2)
+    elif isinstance(value, int):
+        _pack_int(value, buffer)
+    elif isinstance(value, float):
+        buffer.append(0xcb)
+        buffer += struct.pack(">d", value)
+    elif isinstance(value, str):
+        data = value.encode()
+        _pack_header(len(data), buffer, 0xa0, 32, 0xd9, 0xda, 0xdb)
+        buffer += data
+    elif isinstance(value, (bytes, bytearray)):
+        _pack_header(len(value), buffer, None, 0, 0xc4, 0xc5, 0xc6)
+        buffer += value
+    elif isinstance(value, (list, tuple)):
+        _pack_header(len(value), buffer, 0x90, 16, None, 0xdc, 0xdd)
+        for item in value:
+            _pack(item, buffer)
+    elif isinstance(value, dict):
+        _pack_header(len(value), buffer, 0x80, 16, None, 0xde, 0xdf)
+        for key, item in value.items():
+            _pack(key, buffer)
+            _pack(item, buffer)
+    else:
+        raise TypeError(f"msgpackに変換できない型です: {type(value)}")
+
+
+def _pack_int(value: int, buffer: bytearray):
+    if 0 <= value < 0x80:
+        buffer.append(value)
+    elif -32 <= value < 0:
+        buffer.append(value & 0xff)
+    elif 0 <= value <= 0xff:
+        buffer += struct.pack(">BB", 0xcc, value)
+    elif 0 <= value <= 0xffff:
+        buffer += struct.pack(">BH", 0xcd, value)
+    elif 0 <= value <= 0xffffffff:
+        buffer += struct.pack(">BI", 0xce, value)
+    elif 0 <= value:
+        buffer += struct.pack(">BQ", 0xcf, value)
+    elif -0x80 <= value:
+        buffer += struct.pack(">Bb", 0xd0, value)
+    elif -0x8000 <= value:
+        buffer += struct.pack(">Bh", 0xd1, value)
+    elif -0x80000000 <= value:
+        buffer += struct.pack(">Bi", 0xd2, value)
+    else:
+        buffer += struct.pack(">Bq", 0xd3, value)
+
+
+def _pack_header(
+    length: int,
+    buffer: bytearray,
+    fix: Optional[int],
+    fix_limit: int,
+    code8: Optional[int],
+    code16: int,
+    code32: int,
+):
+    if fix is not None and length < fix_limit:
+        buffer.append(fix | length)
+    elif code8 is not None and length <= 0xff:
+        buffer += struct.pack(">BB", code8, length)
+    elif length <= 0xffff:
+        buffer += struct.pack(">BH", code16, length)
+    else:
+        buffer += struct.pack(">BI", code32, length)
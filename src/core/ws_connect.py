@@ -1,9 +1,54 @@
-from typing import List, Dict
-from venv import create
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, Iterable, List, Optional
 from fastapi import WebSocket
 
 from src.schema.response.chat_response import ChatIndexResponse, ChatShowResponse
-from src.core.logging import log
+from src.core.ws_outbound import OutboundConnection, OutboundStats, OverflowPolicy
+from src.core.ws_registry import ConnectionRecord, ConnectionRegistry
+from src.core.ws_backplane import backplane
+from src.core.ws_typing import InputCoalescer
+from src.core.ws_batch import MessageBatcher
+from src.core.ws_heartbeat import heartbeat
+from src.core.ws_codec import Frame, FrameKind, negotiate_wire_format
+from src.core.ws_history import RoomHistory, ws_history_linger
+
+# 再接続時、リングバッファにないメッセージをDBから取得する関数 (部屋ID, 最後に受け取ったメッセージUUID) -> 送信内容
+LoadMissed = Callable[[str, str], Awaitable[List[dict]]]
+
+# 配信基盤のチャンネル
+CHATS_CHANNEL = "chats"
+
+# 一覧用接続のグループ
+ALL_CORPORATIONS = ("all",)
+
+
+def corporation_group(corporation_uuid: str) -> tuple:
+    return ("corporation", corporation_uuid)
+
+
+def user_group(user_id: int) -> tuple:
+    return ("user", user_id)
+
+
+def room_channel(chat_uuid: str) -> str:
+    return f"room:{chat_uuid}"
+
+
+def fan_out(records: Iterable[ConnectionRecord], frame: Frame, key: Optional[Hashable] = None):
+    """フレームを全接続の送信キューに積む
+
+    フレームは送信形式ごとに1度だけエンコードされる。
+    送信は接続ごとの送信タスクが並行して行うため、遅い接続があっても他の接続は待たされない。
+
+    Args:
+        records (Iterable[ConnectionRecord]): 送信先
+        frame (Frame): 送信内容
+        key (Hashable | None): coalesce用のキー
+    """
+    # 送信キュー溢れで切断されると接続一覧が変わるためコピーしてから回す
+    for record in list(records):
+        record.outbound.enqueue(frame.encode(record.wire_format), key)
+
 
 class ConnectionManager:
     _instance = None
@@ -13,38 +58,124 @@ class ConnectionManager:
             cls._instance = super(ConnectionManager, cls).__new__(cls)
             cls._instance._initialize()
         return cls._instance
-    
+
     def _initialize(self):
-        self.active_connections: List[WebSocket] = []
+        # グループ: 全企業(ALL_CORPORATIONS)・企業ごと(corporation_group)・ユーザーごと(user_group)
+        self.registry = ConnectionRegistry()
+        self.outbound_stats = OutboundStats()
+        # 一覧の更新は同じチャットなら最新のものだけ届けば良いのでcoalesceする
+        self.overflow_policy = OverflowPolicy.from_env("WS_INDEX_OVERFLOW_POLICY", OverflowPolicy.COALESCE)
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, allow_compression: bool = False, ping: bool = False):
         """接続する
 
+        認証(subscribe)が済むまでは何も配信しない。
+
+        Args:
+            websocket (WebSocket): WebSocket
+            allow_compression (bool): 圧縮付きの送信形式を受け付けるかどうか
+            ping (bool): アプリのping({"type": "ping"})に応答できるクライアントかどうか
+        """
+        wire_format, subprotocol = negotiate_wire_format(websocket, allow_compression)
+        await websocket.accept(subprotocol=subprotocol)
+        await backplane.start()
+        backplane.subscribe(CHATS_CHANNEL, self._deliver)
+        outbound = OutboundConnection(
+            websocket,
+            self.outbound_stats,
+            policy=self.overflow_policy,
+            on_evict=lambda outbound: self.disconnect(outbound.websocket),
+        )
+        record = ConnectionRecord(websocket, outbound, wire_format=wire_format)
+        self.registry.add(record)
+        if ping:
+            heartbeat.register(record)
+        outbound.start()
+
+    def subscribe(self, websocket: WebSocket, user_id: int, corporation_uuids: Optional[List[str]] = None):
+        """認証済みの接続を配信先に登録する
+
         Args:
             websocket (WebSocket): WebSocket
+            user_id (int): ユーザID
+            corporation_uuids (List[str] | None): 受け取る企業UUID(Noneの場合は全企業)
         """
-        await websocket.accept()
-        self.active_connections.append(websocket)
+        record = self.registry.get(websocket)
+        if record is None:
+            return
+        for group in list(record.groups):
+            self.registry.leave(websocket, group)
+        record.user_id = user_id
+        record.corporation_uuids = corporation_uuids
+        self.registry.join(websocket, user_group(user_id))
+        if corporation_uuids is None:
+            self.registry.join(websocket, ALL_CORPORATIONS)
+        else:
+            for corporation_uuid in corporation_uuids:
+                self.registry.join(websocket, corporation_group(corporation_uuid))
 
     def disconnect(self, websocket: WebSocket):
-        """接続先から切断する
+        """接続先から切断する(切断済みの場合は何もしない)
 
         Args:
             websocket (WebSocket): WebSocket
         """
-        self.active_connections.remove(websocket)
+        heartbeat.unregister(websocket)
+        self.registry.remove(websocket)
+
+    def touch(self, websocket: WebSocket):
+        """クライアントからの受信を記録する(ハートビート用)
 
-    async def broadcast(self, message: ChatIndexResponse.ChatIndexResponseItem):
+        Args:
+            websocket (WebSocket): WebSocket
+        """
+        record = self.registry.get(websocket)
+        if record is not None:
+            record.touch()
+
+    async def broadcast(self, message: ChatIndexResponse.ChatIndexResponseItem, user_id: int | None = None):
         """接続先に配信する
 
+        配信基盤を経由して全ワーカーの接続に届ける。
+        チャットの企業を受け取る接続にだけ配信し、user_idを指定した場合はそのユーザーの接続にだけ配信する。
+
         Args:
-            message (dict): 送信内容
+            message (ChatIndexResponse.ChatIndexResponseItem): 送信内容
+            user_id (int | None): 既読状態などユーザー固有の内容の場合の配信先ユーザID
+        """
+        await backplane.publish(
+            CHATS_CHANNEL,
+            {"user_id": user_id, "data": message.model_dump(mode="json")},
+        )
+
+    def _deliver(self, message: dict):
+        """配信基盤から受け取ったメッセージを1度だけエンコードし、このワーカーの配信対象の送信キューに積む
+
+        Args:
+            message (dict): {user_id: 配信先ユーザID, data: 送信内容}
         """
-        for connection in self.active_connections:
-            message_dict = message.model_dump()
-            message_dict['latest_send_at'] = message_dict['latest_send_at'].isoformat()
-            await connection.send_json(message_dict)
-            
+        data = message["data"]
+        if message["user_id"] is not None:
+            targets = list(self.registry.members(user_group(message["user_id"])))
+        else:
+            targets = [
+                *self.registry.members(ALL_CORPORATIONS),
+                *self.registry.members(corporation_group(data["corporation_uuid"])),
+            ]
+        if not targets:
+            return
+        fan_out(targets, Frame(FrameKind.INDEX, data), key=data["uuid"])
+
+    def stats(self) -> dict:
+        """接続数と送信キューのカウンターを返す"""
+        return {
+            "connections": len(self.registry),
+            "subscribed": sum(1 for record in self.registry.records.values() if record.user_id is not None),
+            "groups": len(self.registry.groups),
+            "bytes_sent": sum(record.bytes_sent for record in self.registry.records.values()),
+            **self.outbound_stats.snapshot(),
+        }
+
 connection_manager = ConnectionManager()
 
 class RoomConnectionManager:
@@ -55,57 +186,298 @@ class RoomConnectionManager:
             cls._instance = super(RoomConnectionManager, cls).__new__(cls)
             cls._instance._initialize()
         return cls._instance
-    
+
     def _initialize(self):
-        self.active_connections: Dict[str, List[WebSocket]] = {}
+        # グループ: 部屋ID(チャットUUID)
+        self.registry = ConnectionRegistry()
+        self.outbound_stats = OutboundStats()
+        # チャットメッセージは欠落させられないので、溢れた接続は切断して再接続させる
+        self.overflow_policy = OverflowPolicy.from_env("WS_ROOM_OVERFLOW_POLICY", OverflowPolicy.DISCONNECT)
+        # 入力中状態は部屋・送信者ごとに間引いてから配信する
+        self.input_coalescer = InputCoalescer(self._publish_input)
+        # バッチ配信を選んだ接続向けに、部屋ごとのメッセージをまとめて配列フレームで送る
+        self.batcher = MessageBatcher(self._flush_batch)
+        # 再接続時の再送用に、購読中の部屋の直近メッセージを保持する
+        self.history = RoomHistory()
+        # 他ワーカーからの配信が抜けた履歴で再送しないよう破棄し、再接続時はDBから取得させる
+        backplane.on_gap(self.history.clear)
+        # 購読中の部屋(接続がなくなってもlingerの間は購読を続ける)
+        self.watched: set = set()
+        self.lingering: Dict[str, asyncio.TimerHandle] = {}
 
-    async def connect(self, websocket: WebSocket, chat_uuid: str):
+    async def connect(
+        self,
+        websocket: WebSocket,
+        chat_uuid: str,
+        corporation_uuid: str | None = None,
+        batch: bool = False,
+        allow_compression: bool = False,
+        last_uuid: str | None = None,
+        load_missed: LoadMissed | None = None,
+        ping: bool = False,
+    ):
         """接続する
 
+        last_uuidを指定した再接続では、それ以降のメッセージを配信の前に再送する。
+        リングバッファで足りない場合だけload_missedでDBから取得する。
+
         Args:
             websocket (WebSocket): WebSocket
             str (str): 部屋ID
+            corporation_uuid (str | None): 企業UUID
+            batch (bool): メッセージをまとめて配列フレームで受け取るかどうか
+            allow_compression (bool): 圧縮付きの送信形式を受け付けるかどうか
+            last_uuid (str | None): クライアントが最後に受け取ったメッセージUUID
+            load_missed (LoadMissed | None): バッファにないメッセージの取得関数
+            ping (bool): アプリのping({"type": "ping"})に応答できるクライアントかどうか
+        """
+        wire_format, subprotocol = negotiate_wire_format(websocket, allow_compression)
+        await websocket.accept(subprotocol=subprotocol)
+        outbound = OutboundConnection(
+            websocket,
+            self.outbound_stats,
+            policy=self.overflow_policy,
+            on_evict=lambda outbound: self.disconnect(outbound.websocket),
+        )
+        record = ConnectionRecord(
+            websocket,
+            outbound,
+            corporation_uuids=[corporation_uuid] if corporation_uuid else None,
+            batch=batch,
+            wire_format=wire_format,
+        )
+        self.registry.add(record)
+        if ping:
+            heartbeat.register(record)
+        await self._watch(chat_uuid)
+        try:
+            missed = await self._missed(chat_uuid, last_uuid, load_missed) if last_uuid else []
+        except BaseException:
+            # 再送分の取得に失敗した(呼び出し元のfinallyより前のため、ここで登録と購読を片付ける)
+            self.disconnect(websocket)
+            if not self.registry.has_group(chat_uuid):
+                self._release_later(chat_uuid)
+            raise
+        if websocket not in self.registry.records:
+            # 再送分の取得中に切断された
+            if not self.registry.has_group(chat_uuid):
+                self._release_later(chat_uuid)
+            return
+        # ここから部屋に参加するまでawaitしないため、再送分と新着の間に抜けや順序の入れ替わりはない
+        if missed:
+            if batch:
+                fan_out([record], Frame(FrameKind.BATCH, missed))
+            else:
+                for data in missed:
+                    fan_out([record], Frame(FrameKind.MESSAGE, data))
+        # まとめ送り待ちのメッセージは履歴に記録済み(再送分に含まれる)のため、参加前に既存の接続へ送り出しておく
+        self.batcher.flush_room(chat_uuid)
+        self.registry.join(websocket, chat_uuid)
+        outbound.start()
+
+    async def _watch(self, chat_uuid: str):
+        """部屋の購読を始める(購読中・猶予中の場合は猶予を取り消すだけ)
+
+        Args:
+            chat_uuid (str): 部屋ID
+        """
+        timer = self.lingering.pop(chat_uuid, None)
+        if timer is not None:
+            timer.cancel()
+        if chat_uuid in self.watched:
+            return
+        self.watched.add(chat_uuid)
+        await backplane.start()
+        backplane.subscribe(room_channel(chat_uuid), self._deliver)
+
+    async def _missed(self, chat_uuid: str, last_uuid: str, load_missed: LoadMissed | None) -> List[dict]:
+        """再接続したクライアントが受け取っていないメッセージを返す
+
+        Args:
+            chat_uuid (str): 部屋ID
+            last_uuid (str): クライアントが最後に受け取ったメッセージUUID
+            load_missed (LoadMissed | None): バッファにないメッセージの取得関数
+
+        Returns:
+            List[dict]: 送信内容(古い順)
+        """
+        missed = self.history.since(chat_uuid, last_uuid)
+        if missed is not None:
+            return missed
+        if load_missed is None:
+            return []
+        sequence = self.history.last_sequence(chat_uuid)
+        loaded = await load_missed(chat_uuid, last_uuid)
+        # 取得中に届いたメッセージはバッファから補う
+        loaded_uuids = {data["uuid"] for data in loaded}
+        return loaded + [
+            data for data in self.history.after(chat_uuid, sequence) if data["uuid"] not in loaded_uuids
+        ]
+
+    def _release_later(self, chat_uuid: str):
+        """接続がなくなった部屋の購読を猶予の後にやめる
+
+        Args:
+            chat_uuid (str): 部屋ID
         """
-        await websocket.accept()
-        if chat_uuid not in self.active_connections:
-            self.active_connections[chat_uuid] = []
-        self.active_connections[chat_uuid].append(websocket)
+        if chat_uuid not in self.watched or chat_uuid in self.lingering:
+            return
+        if ws_history_linger <= 0:
+            self._release(chat_uuid)
+            return
+        self.lingering[chat_uuid] = asyncio.get_running_loop().call_later(
+            ws_history_linger, self._release, chat_uuid
+        )
 
-    def disconnect(self, websocket: WebSocket, chat_uuid: str):
-        """接続先から切断する
+    def _release(self, chat_uuid: str):
+        """部屋の購読をやめ、履歴を破棄する
+
+        Args:
+            chat_uuid (str): 部屋ID
+        """
+        self.lingering.pop(chat_uuid, None)
+        if self.registry.has_group(chat_uuid):
+            return
+        self.watched.discard(chat_uuid)
+        backplane.unsubscribe(room_channel(chat_uuid), self._deliver)
+        self.history.discard(chat_uuid)
+
+    def disconnect(self, websocket: WebSocket, chat_uuid: str | None = None):
+        """接続先から切断する(切断済みの場合は何もしない)
+
+        参加している全ての部屋から取り除き、接続がなくなった部屋は猶予の後に購読をやめる。
 
         Args:
             websocket (WebSocket): WebSocket
-            str (str): 部屋ID
+            str (str | None): 部屋ID(互換のため残している。参加中の部屋は登録簿から引く)
+        """
+        heartbeat.unregister(websocket)
+        for room in self.registry.remove(websocket):
+            self.batcher.discard(room)
+            self._release_later(room)
+
+    def touch(self, websocket: WebSocket):
+        """クライアントからの受信を記録する(ハートビート用)
+
+        Args:
+            websocket (WebSocket): WebSocket
+        """
+        record = self.registry.get(websocket)
+        if record is not None:
+            record.touch()
+
+    def authenticate(self, websocket: WebSocket, user_id: int):
+        """接続を企業側ユーザーの接続として記録する(以降の送信はユーザーからのものとして扱う)
+
+        Args:
+            websocket (WebSocket): WebSocket
+            user_id (int): ユーザID
+        """
+        record = self.registry.get(websocket)
+        if record is not None:
+            record.user_id = user_id
+
+    def user_id(self, websocket: WebSocket) -> int | None:
+        """接続の認証済みユーザIDを返す(ゲストの場合はNone)
+
+        Args:
+            websocket (WebSocket): WebSocket
+        """
+        record = self.registry.get(websocket)
+        return record.user_id if record is not None else None
+
+    def send(self, websocket: WebSocket, data: dict):
+        """1つの接続にだけ送る(受付通知・エラーなど)
+
+        Args:
+            websocket (WebSocket): WebSocket
+            data (dict): 送信内容
         """
-        self.active_connections[chat_uuid].remove(websocket)
-        if not self.active_connections[chat_uuid]:
-            del self.active_connections[chat_uuid]
+        record = self.registry.get(websocket)
+        if record is not None:
+            fan_out([record], Frame(FrameKind.OTHER, data))
 
     async def broadcast(self, message: ChatShowResponse.ChatShowResponseItem, chat_uuid: str):
         """接続先に配信する
 
+        配信基盤を経由して、どのワーカーに接続している参加者にも届ける。
+
         Args:
-            message (dict): 送信内容
+            message (ChatShowResponse.ChatShowResponseItem): 送信内容
             str (str): 部屋ID
         """
-        for connection in self.active_connections[chat_uuid]:
-            message_dict = message.model_dump()
-            message_dict['send_at'] = message_dict['send_at'].isoformat()
-            if message_dict['user']:
-                message_dict['user']['created_at'] = message_dict['user']['created_at'].isoformat()
-                message_dict['user']['updated_at'] = message_dict['user']['updated_at'].isoformat()
-            await connection.send_json(message_dict)
-            
+        # メッセージを送信した時点で送信者の入力中状態は不要になる
+        self.input_coalescer.clear(chat_uuid, (message.sender, message.user.id if message.user else None))
+        await backplane.publish(
+            room_channel(chat_uuid),
+            {"kind": "message", "chat_uuid": chat_uuid, "data": message.model_dump(mode="json")},
+        )
+
     async def input_broadcast(self, message: dict, chat_uuid: str):
         """接続先に入力を配信する
 
+        入力中状態は部屋・送信者(sender, user_id)ごとに最新のものだけを一定間隔でまとめて配信する。
+
+        Args:
+            message (dict): 送信内容
+            str (str): 部屋ID
+        """
+        self.input_coalescer.update(chat_uuid, (message.get("sender"), message.get("user_id")), message)
+
+    async def _publish_input(self, message: dict, chat_uuid: str):
+        """間引いた入力中状態を配信基盤に流す
+
         Args:
             message (dict): 送信内容
             str (str): 部屋ID
         """
-        for connection in self.active_connections[chat_uuid]:
-            await connection.send_json(message)
-            
-            
-room_connection_manager = RoomConnectionManager()
\ No newline at end of file
+        await backplane.publish(
+            room_channel(chat_uuid),
+            {"kind": "input", "chat_uuid": chat_uuid, "data": message},
+        )
+
+    def _deliver(self, message: dict):
+        """配信基盤から受け取ったメッセージを1度だけエンコードし、このワーカーの部屋内の全接続の送信キューに積む
+
+        メッセージは再接続時の再送用に部屋の履歴にも記録する。
+
+        Args:
+            message (dict): {kind: 種別, chat_uuid: 部屋ID, data: 送信内容}
+        """
+        chat_uuid = message["chat_uuid"]
+        if message["kind"] == "message" and chat_uuid in self.watched:
+            self.history.add(chat_uuid, message["data"])
+        if not self.registry.has_group(chat_uuid):
+            return
+        if message["kind"] != "message":
+            fan_out(self.registry.members(chat_uuid), Frame(FrameKind.OTHER, message["data"]))
+            return
+        immediate = [record for record in self.registry.members(chat_uuid) if not record.batch]
+        if immediate:
+            fan_out(immediate, Frame(FrameKind.MESSAGE, message["data"]))
+        if len(immediate) < len(self.registry.groups[chat_uuid]):
+            self.batcher.add(chat_uuid, message["data"])
+
+    def _flush_batch(self, chat_uuid: str, items: List[dict]):
+        """溜まったメッセージを1つの配列フレームにしてバッチ配信の接続に送る
+
+        Args:
+            chat_uuid (str): 部屋ID
+            items (List[dict]): 送信内容
+        """
+        targets = [record for record in self.registry.members(chat_uuid) if record.batch]
+        if targets:
+            fan_out(targets, Frame(FrameKind.BATCH, items))
+
+    def stats(self) -> dict:
+        """部屋数・接続数と送信キューのカウンターを返す"""
+        return {
+            "rooms": len(self.registry.groups),
+            "connections": len(self.registry),
+            "history": self.history.stats(),
+            "bytes_sent": sum(record.bytes_sent for record in self.registry.records.values()),
+            **self.outbound_stats.snapshot(),
+        }
+
+
+room_connection_manager = RoomConnectionManager()
@@ -0,0 +1,114 @@
+import asyncio
+import math
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+from fastapi import WebSocket, status
+
+from src.core.logging import log_error
+from src.core.ws_registry import ConnectionRecord
+from src.core.ws_codec import Frame, FrameKind
+
+# 最後の受信からpingを送るまでの時間(秒) 0の場合はハートビートを行わない
+ws_heartbeat_interval = float(os.getenv("WS_HEARTBEAT_INTERVAL", "25"))
+# ping送信後、応答がなければ切断するまでの時間(秒)
+ws_heartbeat_timeout = float(os.getenv("WS_HEARTBEAT_TIMEOUT", "20"))
+# タイマーホイールの1目盛り(秒)
+ws_heartbeat_tick = float(os.getenv("WS_HEARTBEAT_TICK", "1"))
+
+PING_FRAME = Frame(FrameKind.OTHER, {"type": "ping"})
+
+
+class HeartbeatWheel:
+    """WebSocket接続のハートビートを1つのタイマーホイールで管理する
+
+    接続はホイールのスロットに登録され、1目盛りごとに該当スロットの接続だけを確認する。
+    最後の受信(touch)からintervalが経った接続にはpingを送り、さらにtimeoutの間何も受信しなければ切断する。
+    クライアントはpingに対して任意のフレーム({"type": "pong"}など)を返せばよい。
+    pingはデータフレームとして届くため、応答できると申告した接続(ping=true)だけを対象にする。
+    それ以外の接続の死活確認はプロトコルのping(uvicornのws_ping_interval)に任せる。
+    """
+
+    def __init__(
+        self,
+        interval: float = ws_heartbeat_interval,
+        timeout: float = ws_heartbeat_timeout,
+        tick: float = ws_heartbeat_tick,
+    ):
+        self.interval = interval
+        self.timeout = timeout
+        self.tick = tick
+        size = math.ceil(max(interval, timeout) / tick) + 1 if interval > 0 else 1
+        self.slots: List[Dict[WebSocket, ConnectionRecord]] = [{} for _ in range(size)]
+        # 接続 -> (スロット番号, ping送信時刻)
+        self.entries: Dict[WebSocket, Tuple[int, Optional[float]]] = {}
+        self.cursor = 0
+        self.reaped = 0
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0
+
+    def register(self, record: ConnectionRecord):
+        """接続をハートビートの対象にする
+
+        Args:
+            record (ConnectionRecord): 接続情報
+        """
+        if not self.enabled:
+            return
+        record.last_seen = time.monotonic()
+        self._schedule(record, self.interval, None)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def unregister(self, websocket: WebSocket):
+        """接続をハートビートの対象から外す(登録されていない場合は何もしない)
+
+        Args:
+            websocket (WebSocket): WebSocket
+        """
+        entry = self.entries.pop(websocket, None)
+        if entry is not None:
+            self.slots[entry[0]].pop(websocket, None)
+
+    def stats(self) -> dict:
+        """ハートビート対象の接続数と切断数を返す"""
+        return {"enabled": self.enabled, "connections": len(self.entries), "reaped": self.reaped}
+
+    def _schedule(self, record: ConnectionRecord, delay: float, pinged_at: Optional[float]):
+        self.unregister(record.websocket)
+        ticks = min(max(1, math.ceil(delay / self.tick)), len(self.slots) - 1)
+        slot = (self.cursor + ticks) % len(self.slots)
+        self.slots[slot][record.websocket] = record
+        self.entries[record.websocket] = (slot, pinged_at)
+
+    async def _run(self):
+        while self.entries:
+            await asyncio.sleep(self.tick)
+            self.cursor = (self.cursor + 1) % len(self.slots)
+            try:
+                self._advance()
+            except Exception as e:
+                log_error(e)
+
+    def _advance(self):
+        due, self.slots[self.cursor] = self.slots[self.cursor], {}
+        now = time.monotonic()
+        for websocket, record in due.items():
+            _, pinged_at = self.entries.pop(websocket)
+            idle = now - record.last_seen
+            if idle < self.interval:
+                # pingの後に受信があった、もしくはまだpingの時間ではない
+                self._schedule(record, self.interval - idle, None)
+            elif pinged_at is None:
+                record.outbound.enqueue(PING_FRAME.encode(record.wire_format))
+                self._schedule(record, self.timeout, now)
+            elif now - pinged_at >= self.timeout:
+                self.reaped += 1
+                record.outbound.evict("heartbeat timeout", status.WS_1011_INTERNAL_ERROR)
+            else:
+                self._schedule(record, self.timeout - (now - pinged_at), pinged_at)
+
+heartbeat = HeartbeatWheel()
@@ -0,0 +1,91 @@
+import os
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+# 部屋ごとに保持する直近のメッセージ数
+ws_history_size = int(os.getenv("WS_HISTORY_SIZE", "100"))
+# 部屋の接続がなくなってから履歴を破棄するまでの時間(秒) 再接続までの間も履歴を途切れさせないため
+ws_history_linger = float(os.getenv("WS_HISTORY_LINGER", "60"))
+
+
+class RoomHistory:
+    """部屋ごとの直近メッセージのリングバッファ
+
+    再接続したクライアントが最後に受け取ったメッセージUUIDを送ると、それ以降のメッセージをメモリから返す。
+    各メッセージにはこのワーカー内で部屋ごとに増える連番を振り、再送中に届いたメッセージの判定に使う。
+    """
+
+    def __init__(self, size: int = ws_history_size):
+        self.size = size
+        # 部屋ID -> (連番, 送信内容)のリングバッファ
+        self.rooms: Dict[str, Deque[Tuple[int, dict]]] = {}
+        self.sequences: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, chat_uuid: str, data: dict):
+        """メッセージを記録する
+
+        Args:
+            chat_uuid (str): 部屋ID
+            data (dict): 送信内容
+        """
+        sequence = self.sequences.get(chat_uuid, 0) + 1
+        self.sequences[chat_uuid] = sequence
+        self.rooms.setdefault(chat_uuid, deque(maxlen=self.size)).append((sequence, data))
+
+    def last_sequence(self, chat_uuid: str) -> int:
+        """部屋で最後に記録したメッセージの連番を返す(記録がなければ0)"""
+        return self.sequences.get(chat_uuid, 0)
+
+    def since(self, chat_uuid: str, last_uuid: str) -> Optional[List[dict]]:
+        """指定したメッセージより後のメッセージを返す
+
+        Args:
+            chat_uuid (str): 部屋ID
+            last_uuid (str): クライアントが最後に受け取ったメッセージUUID
+
+        Returns:
+            List[dict] | None: 以降のメッセージ(バッファに指定したメッセージがない場合はNone)
+        """
+        items = self.rooms.get(chat_uuid, ())
+        for index in range(len(items) - 1, -1, -1):
+            if items[index][1].get("uuid") == last_uuid:
+                self.hits += 1
+                return [data for _, data in list(items)[index + 1:]]
+        self.misses += 1
+        return None
+
+    def after(self, chat_uuid: str, sequence: int) -> List[dict]:
+        """指定した連番より後に記録したメッセージを返す
+
+        Args:
+            chat_uuid (str): 部屋ID
+            sequence (int): last_sequenceで取得した連番
+
+        Returns:
+            List[dict]: 以降のメッセージ
+        """
+        return [data for number, data in self.rooms.get(chat_uuid, ()) if number > sequence]
+
+    def discard(self, chat_uuid: str):
+        """部屋の履歴を破棄する
+
+        Args:
+            chat_uuid (str): 部屋ID
+        """
+        self.rooms.pop(chat_uuid, None)
+        self.sequences.pop(chat_uuid, None)
+
+    def clear(self):
+        """全部屋の履歴を破棄する(配信の抜けで履歴が信用できなくなった時。連番は引き継ぐ)"""
+        self.rooms.clear()
+
+    def stats(self) -> dict:
+        """履歴を持つ部屋数と再送の成否を返す"""
+        return {
+            "rooms": len(self.rooms),
+            "messages": sum(len(items) for items in self.rooms.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
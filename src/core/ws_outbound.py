@@ -0,0 +1,197 @@
+import asyncio
+import os
+from collections import deque
+from typing import Callable, Deque, Dict, Hashable, List, Optional, Union
+from fastapi import WebSocket, status
+
+from src.core.logging import log
+
+# 1接続あたりの送信タイムアウト(秒)
+ws_send_timeout = float(os.getenv("WS_SEND_TIMEOUT", "5"))
+# 1接続あたりの送信キューの上限
+ws_queue_size = int(os.getenv("WS_QUEUE_SIZE", "256"))
+
+
+class OverflowPolicy:
+    """送信キューが溢れた時の振る舞い"""
+    DROP_OLDEST = "drop_oldest"  # 最も古いフレームを捨てる
+    COALESCE = "coalesce"  # 同じキーのフレームは最新のものに置き換え、溢れたら最も古いフレームを捨てる
+    DISCONNECT = "disconnect"  # 接続を切断する
+
+    ALL = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+    @classmethod
+    def from_env(cls, name: str, default: str) -> str:
+        policy = os.getenv(name, default)
+        if policy not in cls.ALL:
+            raise ValueError(f"{name}の値が不正です: {policy}")
+        return policy
+
+
+class OutboundStats:
+    """送信キューのカウンター(接続マネージャーごとに持つ)"""
+
+    def __init__(self):
+        self.counters: Dict[str, int] = {
+            "enqueued": 0,
+            "sent": 0,
+            "dropped": 0,
+            "coalesced": 0,
+            "send_failed": 0,
+            "evicted": 0,
+        }
+
+    def incr(self, name: str, value: int = 1):
+        self.counters[name] += value
+
+    def snapshot(self) -> Dict[str, int]:
+        return dict(self.counters)
+
+
+class OutboundConnection:
+    """送信キューを持つWebSocket接続
+
+    配信処理はキューに積むだけで、実際の送信は接続ごとの送信タスクが行う。
+    そのため遅いクライアントがいても配信元(HTTPリクエスト等)は待たされない。
+    """
+    __slots__ = (
+        "websocket",
+        "stats",
+        "policy",
+        "maxsize",
+        "on_evict",
+        "queue",
+        "keyed",
+        "closed",
+        "frames_sent",
+        "bytes_sent",
+        "_wakeup",
+        "_task",
+    )
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        stats: OutboundStats,
+        policy: str = OverflowPolicy.DROP_OLDEST,
+        maxsize: int = ws_queue_size,
+        on_evict: Optional[Callable[["OutboundConnection"], None]] = None,
+    ):
+        self.websocket = websocket
+        self.stats = stats
+        self.policy = policy
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        # 要素は[キー, フレーム]のリスト(coalesce時にフレームだけ差し替えるため)
+        self.queue: Deque[List] = deque()
+        self.keyed: Dict[Hashable, List] = {}
+        self.closed = False
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """送信タスクを開始する"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._writer())
+
+    def stop(self):
+        """送信タスクを停止する(キューに残ったフレームは破棄する)"""
+        self.closed = True
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+        self._task = None
+        self.queue.clear()
+        self.keyed.clear()
+
+    def enqueue(self, frame: Union[str, bytes], key: Optional[Hashable] = None) -> bool:
+        """フレームを送信キューに積む
+
+        Args:
+            frame (str | bytes): エンコード済みの送信内容(bytesはバイナリフレームで送る)
+            key (Hashable | None): coalesce用のキー(同じキーのフレームは最新のもので置き換える)
+
+        Returns:
+            bool: キューに積めた場合True
+        """
+        if self.closed:
+            return False
+        if self.policy == OverflowPolicy.COALESCE and key is not None and key in self.keyed:
+            self.keyed[key][1] = frame
+            self.stats.incr("coalesced")
+            return True
+        if len(self.queue) >= self.maxsize:
+            if self.policy == OverflowPolicy.DISCONNECT:
+                self.evict("queue overflow", status.WS_1013_TRY_AGAIN_LATER)
+                return False
+            self._pop()
+            self.stats.incr("dropped")
+        entry = [key, frame]
+        self.queue.append(entry)
+        if key is not None and self.policy == OverflowPolicy.COALESCE:
+            self.keyed[key] = entry
+        self.stats.incr("enqueued")
+        self._wakeup.set()
+        return True
+
+    def _pop(self) -> Union[str, bytes]:
+        entry = self.queue.popleft()
+        key = entry[0]
+        if key is not None and self.keyed.get(key) is entry:
+            del self.keyed[key]
+        return entry[1]
+
+    async def _writer(self):
+        while not self.closed:
+            if not self.queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            frame = self._pop()
+            try:
+                if isinstance(frame, bytes):
+                    await asyncio.wait_for(self.websocket.send_bytes(frame), timeout=ws_send_timeout)
+                    self.bytes_sent += len(frame)
+                else:
+                    await asyncio.wait_for(self.websocket.send_text(frame), timeout=ws_send_timeout)
+                    self.bytes_sent += len(frame.encode())
+                self.frames_sent += 1
+                self.stats.incr("sent")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats.incr("send_failed")
+                self.evict(f"send failed: {e!r}", status.WS_1011_INTERNAL_ERROR)
+                return
+
+    def evict(self, reason: str, code: int):
+        """応答しないクライアントを切断する
+
+        正常終了(1000)ではなくcodeで切断し、クライアントに取りこぼした分を再接続で受け取らせる。
+
+        Args:
+            reason (str): 切断理由
+            code (int): クローズコード(キューの溢れは1013、応答なしは1011)
+        """
+        if self.closed:
+            return
+        log(f"websocket evicted: {reason}")
+        self.stats.incr("evicted")
+        self.stop()
+        if self.on_evict is not None:
+            self.on_evict(self)
+        asyncio.get_running_loop().create_task(close_quietly(self.websocket, code))
+
+
+async def close_quietly(websocket: WebSocket, code: int = status.WS_1000_NORMAL_CLOSURE):
+    """接続を閉じる(既に切断済みの場合は無視する)
+
+    Args:
+        websocket (WebSocket): WebSocket
+        code (int): クローズコード
+    """
+    try:
+        await websocket.close(code=code)
+    except Exception:
+        pass
@@ -0,0 +1,71 @@
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Tuple
+
+from src.core.logging import log_error
+
+# 配信処理(保存済みのデータだけを使い、DBには触れないこと)
+Event = Callable[[], Awaitable[None]]
+
+
+class Outbox:
+    """コミット済みのイベントを配信するプロセス内のキュー
+
+    保存処理はイベントを積むだけで戻り、配信はバックグラウンドのタスクが行う。
+    同じ部屋のイベントは積んだ順に1つずつ配信し、別の部屋のイベントは並行して配信する。
+    部屋ごとのタスクはキューが空になると終了する。
+    """
+
+    def __init__(self):
+        # 部屋ID -> (積んだ時刻, イベント)のキュー
+        self.lanes: Dict[str, Deque[Tuple[float, Event]]] = {}
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.counters: Dict[str, int] = {"enqueued": 0, "delivered": 0, "failed": 0}
+        # 積んでから配信を始めるまでの待ち時間(秒)
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+
+    def put(self, chat_uuid: str, event: Event):
+        """イベントを積む(配信の完了は待たない)
+
+        Args:
+            chat_uuid (str): 部屋ID(同じ部屋のイベントは積んだ順に配信される)
+            event (Event): 配信処理
+        """
+        self.lanes.setdefault(chat_uuid, deque()).append((time.monotonic(), event))
+        self.counters["enqueued"] += 1
+        if chat_uuid not in self.tasks:
+            self.tasks[chat_uuid] = asyncio.create_task(self._drain(chat_uuid))
+
+    async def _drain(self, chat_uuid: str):
+        lane = self.lanes[chat_uuid]
+        try:
+            while lane:
+                enqueued_at, event = lane.popleft()
+                lag = time.monotonic() - enqueued_at
+                self.lag_total += lag
+                self.lag_max = max(self.lag_max, lag)
+                try:
+                    await event()
+                    self.counters["delivered"] += 1
+                except Exception as e:
+                    self.counters["failed"] += 1
+                    log_error(e)
+        finally:
+            self.lanes.pop(chat_uuid, None)
+            self.tasks.pop(chat_uuid, None)
+
+    def stats(self) -> dict:
+        """配信待ちの件数と配信数・待ち時間を返す"""
+        started = self.counters["delivered"] + self.counters["failed"]
+        return {
+            **self.counters,
+            "pending": sum(len(lane) for lane in self.lanes.values()),
+            "rooms": len(self.lanes),
+            "lag_avg_ms": round(self.lag_total / started * 1000, 3) if started else 0.0,
+            "lag_max_ms": round(self.lag_max * 1000, 3),
+        }
+
+
+outbox = Outbox()
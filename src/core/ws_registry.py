@@ -0,0 +1,155 @@
+import time
+from datetime import datetime, timezone
+from typing import Dict, Hashable, Iterable, List, Optional, Set
+from fastapi import WebSocket
+
+from src.core.ws_outbound import OutboundConnection
+from src.core.ws_codec import WireFormat
+
+
+class ConnectionRecord:
+    """WebSocket接続1つ分の情報"""
+    __slots__ = (
+        "websocket",
+        "outbound",
+        "user_id",
+        "corporation_uuids",
+        "connected_at",
+        "groups",
+        "batch",
+        "last_seen",
+        "wire_format",
+    )
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        outbound: OutboundConnection,
+        user_id: Optional[int] = None,
+        corporation_uuids: Optional[List[str]] = None,
+        batch: bool = False,
+        wire_format: str = WireFormat.JSON,
+    ):
+        self.websocket = websocket
+        self.outbound = outbound
+        self.user_id = user_id
+        self.corporation_uuids = corporation_uuids
+        self.connected_at = datetime.now(timezone.utc)
+        # 参加しているグループ(部屋・企業など)の逆引き
+        self.groups: Set[Hashable] = set()
+        # メッセージをまとめて配列フレームで受け取るかどうか(接続時に指定)
+        self.batch = batch
+        # 最後にクライアントから受信した時刻(time.monotonic)
+        self.last_seen = time.monotonic()
+        # 送信形式(サブプロトコルで指定)
+        self.wire_format = wire_format
+
+    def touch(self):
+        """クライアントからの受信を記録する(ハートビート用)"""
+        self.last_seen = time.monotonic()
+
+    @property
+    def bytes_sent(self) -> int:
+        return self.outbound.bytes_sent
+
+    def to_dict(self) -> dict:
+        return {
+            "user_id": self.user_id,
+            "corporation_uuids": self.corporation_uuids,
+            "connected_at": self.connected_at.isoformat(),
+            "groups": len(self.groups),
+            "batch": self.batch,
+            "wire_format": self.wire_format,
+            "frames_sent": self.outbound.frames_sent,
+            "bytes_sent": self.outbound.bytes_sent,
+            "queued": len(self.outbound.queue),
+        }
+
+
+class ConnectionRegistry:
+    """WebSocket接続の登録簿
+
+    接続とグループ(部屋・企業など)の対応を辞書で持ち、接続側にも参加グループの逆引きを持たせることで
+    登録・削除・グループ参加/離脱をいずれも接続数に依存せず行う。
+    """
+
+    def __init__(self):
+        self.records: Dict[WebSocket, ConnectionRecord] = {}
+        self.groups: Dict[Hashable, Dict[WebSocket, ConnectionRecord]] = {}
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def add(self, record: ConnectionRecord):
+        """接続を登録する
+
+        Args:
+            record (ConnectionRecord): 接続情報
+        """
+        self.records[record.websocket] = record
+
+    def get(self, websocket: WebSocket) -> Optional[ConnectionRecord]:
+        return self.records.get(websocket)
+
+    def remove(self, websocket: WebSocket) -> List[Hashable]:
+        """接続を削除し、参加していた全グループから取り除く(未登録の場合は何もしない)
+
+        Args:
+            websocket (WebSocket): WebSocket
+
+        Returns:
+            List[Hashable]: 削除により空になったグループ
+        """
+        record = self.records.pop(websocket, None)
+        if record is None:
+            return []
+        emptied = [group for group in list(record.groups) if self.leave(websocket, group, record)]
+        record.outbound.stop()
+        return emptied
+
+    def join(self, websocket: WebSocket, group: Hashable) -> bool:
+        """接続をグループに参加させる
+
+        Args:
+            websocket (WebSocket): WebSocket
+            group (Hashable): グループ
+
+        Returns:
+            bool: グループが新しく作られた場合True
+        """
+        record = self.records.get(websocket)
+        if record is None:
+            return False
+        created = group not in self.groups
+        self.groups.setdefault(group, {})[websocket] = record
+        record.groups.add(group)
+        return created
+
+    def leave(self, websocket: WebSocket, group: Hashable, record: Optional[ConnectionRecord] = None) -> bool:
+        """接続をグループから外す
+
+        Args:
+            websocket (WebSocket): WebSocket
+            group (Hashable): グループ
+            record (ConnectionRecord | None): 登録簿から削除済みの接続情報
+
+        Returns:
+            bool: グループが空になり削除された場合True
+        """
+        record = record or self.records.get(websocket)
+        if record is not None:
+            record.groups.discard(group)
+        members = self.groups.get(group)
+        if members is None:
+            return False
+        members.pop(websocket, None)
+        if members:
+            return False
+        del self.groups[group]
+        return True
+
+    def members(self, group: Hashable) -> Iterable[ConnectionRecord]:
+        return self.groups.get(group, {}).values()
+
+    def has_group(self, group: Hashable) -> bool:
+        return group in self.groups
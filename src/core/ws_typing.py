@@ -0,0 +1,77 @@
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from src.core.logging import log_error
+
+# 入力中状態をまとめて配信する間隔(秒)
+ws_typing_window = float(os.getenv("WS_TYPING_WINDOW", "0.3"))
+# 更新のない入力中状態を終了扱いにするまでの時間(秒)
+ws_typing_ttl = float(os.getenv("WS_TYPING_TTL", "5"))
+
+Publish = Callable[[dict, str], Awaitable[None]]
+
+
+class InputCoalescer:
+    """入力中(typing)状態の間引き
+
+    部屋・送信者ごとに最新の状態だけを保持し、windowごとにまとめて配信する。
+    ttlの間更新がない入力中状態は終了(is_typing=False)として配信して破棄する。
+    全部屋で1つのタイマータスクを共有し、保持している状態がなくなると停止する。
+    """
+
+    def __init__(self, publish: Publish, window: float = ws_typing_window, ttl: float = ws_typing_ttl):
+        self.publish = publish
+        self.window = window
+        self.ttl = ttl
+        # (部屋ID, 送信者キー) -> 未配信の最新状態
+        self.pending: Dict[Tuple[str, Hashable], dict] = {}
+        # (部屋ID, 送信者キー) -> (最終更新時刻, 配信済みの最新状態)
+        self.active: Dict[Tuple[str, Hashable], Tuple[float, dict]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def update(self, chat_uuid: str, sender_key: Hashable, message: dict):
+        """入力中状態を更新する(次のtickで配信される)
+
+        Args:
+            chat_uuid (str): 部屋ID
+            sender_key (Hashable): 送信者を識別するキー
+            message (dict): 入力中状態
+        """
+        key = (chat_uuid, sender_key)
+        self.pending[key] = message
+        self.active[key] = (time.monotonic(), message)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def clear(self, chat_uuid: str, sender_key: Hashable):
+        """送信者の入力中状態を破棄する(メッセージ送信時など)
+
+        Args:
+            chat_uuid (str): 部屋ID
+            sender_key (Hashable): 送信者を識別するキー
+        """
+        key = (chat_uuid, sender_key)
+        self.pending.pop(key, None)
+        self.active.pop(key, None)
+
+    async def _run(self):
+        while self.pending or self.active:
+            await asyncio.sleep(self.window)
+            try:
+                await self._tick()
+            except Exception as e:
+                log_error(e)
+
+    async def _tick(self):
+        pending, self.pending = self.pending, {}
+        for (chat_uuid, _), message in pending.items():
+            await self.publish(message, chat_uuid)
+
+        now = time.monotonic()
+        expired = [key for key, (updated_at, _) in self.active.items() if now - updated_at >= self.ttl]
+        for key in expired:
+            _, message = self.active.pop(key)
+            if message.get("is_typing", True):
+                await self.publish({**message, "is_typing": False}, key[0])
@@ -0,0 +1,196 @@
+"""リポジトリのクエリの実行計画チェック
+
+リポジトリの参照系メソッドを実際のDBに対して実行し、発行されたSELECTのEXPLAINを取得する。
+インデックスを使わないフルスキャン(type=ALL)になっているクエリがあれば一覧を出して終了コード1で終わる。
+
+    make explain-check  (コンテナ内で python -m src.database.explain_check)
+
+EXPLAIN_ALLOWED_FULL_SCAN: フルスキャンを許可するテーブル(カンマ区切り。件数の少ないマスタなど)
+"""
+import asyncio
+import os
+import sys
+from datetime import datetime
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from sqlalchemy import event, select
+
+from src.core.cursor import encode_cursor
+from src.core.ngram import terms
+from src.core.dependency import di_injector
+from src.database.database import DatabaseConnection
+from src.model.chat import Chats
+from src.model.chat_message import ChatMessages
+from src.model.user import Users
+from src.model.corporation import Corporations
+from src.repository.chat_repository import ChatRepository
+from src.repository.user_repository import UserRepository
+from src.repository.corporation_repository import CorporationRepository
+
+# 全チェック共通でフルスキャンを許可するテーブル
+allowed_full_scan = {table for table in os.getenv("EXPLAIN_ALLOWED_FULL_SCAN", "").split(",") if table}
+
+# 該当データがない場合に使う値
+MISSING = "00000000-0000-0000-0000-000000000000"
+
+
+class Check:
+    """チェック対象のリポジトリ呼び出し"""
+
+    def __init__(
+        self,
+        name: str,
+        call: Callable[[dict], Awaitable],
+        allow: Tuple[str, ...] = (),
+        requires_chat: bool = False,
+    ):
+        """
+        Args:
+            name (str): 表示名
+            call (Callable[[dict], Awaitable]): サンプル値を受け取りリポジトリを呼び出す関数
+            allow (Tuple[str, ...]): このチェックでフルスキャンを許可するテーブル
+            requires_chat (bool): チャットが1件もない場合は実行できないかどうか
+        """
+        self.name = name
+        self.call = call
+        self.allow = allow
+        self.requires_chat = requires_chat
+
+
+def checks() -> List[Check]:
+    chat = di_injector.get_class(ChatRepository)
+    user = di_injector.get_class(UserRepository)
+    corporation = di_injector.get_class(CorporationRepository)
+    now = str(int(datetime.now().timestamp()))
+    # (送信日時, ID)のカーソル
+    keyset = encode_cursor(datetime.now(), 2**31 - 1)
+    return [
+        Check("chat.get_chat_by_uuid", lambda s: chat.get_chat_by_uuid(s["chat_uuid"] or MISSING, s["user_id"])),
+        Check("chat.resolve_chat", lambda s: chat.resolve_chat(MISSING)),
+        Check("chat.get_chats", lambda s: chat.get_chats(None, 20, None, s["user_id"])),
+        Check("chat.get_chats(cursor)", lambda s: chat.get_chats(keyset, 20, None, s["user_id"])),
+        Check("chat.get_chats(legacy cursor)", lambda s: chat.get_chats(now, 20, None, s["user_id"])),
+        Check("chat.get_chats(unread_only)", lambda s: chat.get_chats(None, 20, None, s["user_id"], True)),
+        # 企業名はFULLTEXTインデックス(ngram)で探す
+        Check("chat.get_chats(keyword)", lambda s: chat.get_chats(None, 20, s["keyword"], s["user_id"])),
+        # ngramより短いキーワードは中間一致になりインデックスを使えない
+        Check(
+            "chat.get_chats(short keyword)",
+            lambda s: chat.get_chats(None, 20, "a", s["user_id"]),
+            allow=("corporations",),
+        ),
+        Check(
+            "chat.get_chat_messages",
+            lambda s: chat.get_chat_messages(s["chat_uuid"], None, 20),
+            requires_chat=True,
+        ),
+        Check(
+            "chat.get_chat_messages(cursor)",
+            lambda s: chat.get_chat_messages(s["chat_uuid"], keyset, 20),
+            requires_chat=True,
+        ),
+        Check(
+            "chat.get_chat_messages_after",
+            lambda s: chat.get_chat_messages_after(s["chat_uuid"], s["message_uuid"], 200),
+            requires_chat=True,
+        ),
+        # 本文の転置インデックスを企業・ngramの主キーで辿る
+        Check(
+            "chat.search_chat_messages",
+            lambda s: chat.search_chat_messages(s["corporation_uuid"], terms("お問い合わせ 料金"), None, 20),
+        ),
+        Check("user.get_user_by_uuid", lambda s: user.get_user_by_uuid(s["user_uuid"])),
+        Check("user.get_user_by_refresh_token", lambda s: user.get_user_by_refresh_token(s["refresh_token"])),
+        Check("user.get_user_by_email", lambda s: user.get_user_by_email(s["email"])),
+        Check(
+            "corporation.get_corporation_by_uuid",
+            lambda s: corporation.get_corporation_by_uuid(s["corporation_uuid"]),
+        ),
+    ]
+
+
+class PlanRecorder:
+    """実行されたSELECTの直前に同じ接続でEXPLAINを実行して記録する"""
+
+    def __init__(self, db: DatabaseConnection):
+        self.engine = db.engine.sync_engine
+        self.plans: List[Tuple[str, List[dict]]] = []
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._explain)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(self.engine, "before_cursor_execute", self._explain)
+
+    def _explain(self, conn, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith("SELECT"):
+            return
+        cursor.execute("EXPLAIN " + statement, parameters)
+        columns = [column[0] for column in cursor.description]
+        self.plans.append((statement, [dict(zip(columns, row)) for row in cursor.fetchall()]))
+
+
+async def samples(db: DatabaseConnection) -> dict:
+    """実行計画を取るためのサンプル値をDBから取得する"""
+    async with db.get_db() as session:
+        async def first(column) -> Optional[object]:
+            result = await session.execute(select(column).order_by(column.desc()).limit(1))
+            return result.scalar()
+
+        return {
+            "chat_uuid": await first(Chats.uuid),
+            "message_uuid": await first(ChatMessages.uuid) or MISSING,
+            "user_id": await first(Users.id),
+            "user_uuid": await first(Users.uuid) or MISSING,
+            "refresh_token": await first(Users.refresh_token) or MISSING,
+            "email": await first(Users.email) or MISSING,
+            "corporation_uuid": await first(Corporations.uuid) or MISSING,
+            "keyword": "株式",
+        }
+
+
+def full_scans(plan: List[dict], allow: Tuple[str, ...]) -> List[str]:
+    """フルスキャンしているテーブルを返す(派生テーブル・許可したテーブルを除く)"""
+    return [
+        row["table"]
+        for row in plan
+        if row.get("type") == "ALL"
+        and row.get("table")
+        and not row["table"].startswith("<")
+        and row["table"] not in allow
+        and row["table"] not in allowed_full_scan
+    ]
+
+
+async def main() -> int:
+    db = di_injector.get_class(DatabaseConnection)
+    sample = await samples(db)
+    failures = []
+    for check in checks():
+        if sample["chat_uuid"] is None and check.requires_chat:
+            print(f"SKIP {check.name}: チャットがありません")
+            continue
+        with PlanRecorder(db) as recorder:
+            await check.call(sample)
+        for statement, plan in recorder.plans:
+            # 別名(chats_1など)でも元のテーブル名で許可できるようにする
+            allow = check.allow + tuple(f"{table}_1" for table in check.allow)
+            scans = full_scans(plan, allow)
+            status = "NG" if scans else "OK"
+            print(f"{status} {check.name}")
+            for row in plan:
+                print(
+                    f"    {row.get('table')}: type={row.get('type')} key={row.get('key')} "
+                    f"rows={row.get('rows')} extra={row.get('Extra')}"
+                )
+            if scans:
+                failures.append((check.name, scans, statement))
+    await db.close_engine()
+    for name, scans, statement in failures:
+        print(f"\nフルスキャン: {name} ({', '.join(scans)})\n{statement}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,73 @@
+"""collapse_chat_reads_to_watermarks
+
+Revision ID: 3f8b2d6a9e41
+Revises: e2a9c6f4b813
+Create Date: 2026-10-18 12:30:44.905116
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f8b2d6a9e41'
+down_revision: Union[str, None] = 'e2a9c6f4b813'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('chat_read_watermarks',
+    sa.Column('id', sa.Integer(), nullable=False, comment='ID'),
+    sa.Column('chat_id', sa.Integer(), nullable=False, comment='チャットID'),
+    sa.Column('user_id', sa.Integer(), nullable=False, comment='ユーザID'),
+    sa.Column('last_read_message_id', sa.Integer(), nullable=False, comment='既読にした最後のメッセージID'),
+    sa.Column('created_at', sa.TIMESTAMP(timezone=True), nullable=True),
+    sa.Column('updated_at', sa.TIMESTAMP(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['chat_id'], ['chats.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('chat_id', 'user_id', name='uq_chat_read_watermarks_chat_id_user_id')
+    )
+    # 既読処理はチャットのゲストのメッセージをまとめて既読にしていたため、既読にした最大のメッセージIDを既読位置とする
+    op.execute(
+        """
+        INSERT INTO chat_read_watermarks (chat_id, user_id, last_read_message_id, created_at, updated_at)
+        SELECT chat_messages.chat_id, chat_reads.user_id, MAX(chat_reads.message_id),
+            MIN(chat_reads.created_at), MAX(chat_reads.updated_at)
+        FROM chat_reads
+        JOIN chat_messages ON chat_messages.id = chat_reads.message_id
+        WHERE chat_reads.user_id IS NOT NULL
+        GROUP BY chat_messages.chat_id, chat_reads.user_id
+        """
+    )
+    op.drop_table('chat_reads')
+
+
+def downgrade() -> None:
+    op.create_table('chat_reads',
+    sa.Column('id', sa.Integer(), nullable=False, comment='ID'),
+    sa.Column('user_id', sa.Integer(), nullable=True, comment='ユーザID'),
+    sa.Column('message_id', sa.Integer(), nullable=False, comment='企業ID'),
+    sa.Column('created_at', sa.TIMESTAMP(timezone=True), nullable=True),
+    sa.Column('updated_at', sa.TIMESTAMP(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['message_id'], ['chat_messages.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_chat_reads_message_id_user_id', 'chat_reads', ['message_id', 'user_id'], unique=False)
+    # 既読位置以前のゲストのメッセージごとの既読に戻す
+    op.execute(
+        """
+        INSERT INTO chat_reads (user_id, message_id, created_at, updated_at)
+        SELECT chat_read_watermarks.user_id, chat_messages.id,
+            chat_read_watermarks.updated_at, chat_read_watermarks.updated_at
+        FROM chat_read_watermarks
+        JOIN chat_messages ON chat_messages.chat_id = chat_read_watermarks.chat_id
+            AND chat_messages.sender = 2
+            AND chat_messages.id <= chat_read_watermarks.last_read_message_id
+        """
+    )
+    op.drop_table('chat_read_watermarks')
@@ -0,0 +1,48 @@
+"""add_summary_to_chats
+
+Revision ID: 7b3e5d91c2a4
+Revises: 528871a6865e
+Create Date: 2026-10-18 10:12:31.482913
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7b3e5d91c2a4'
+down_revision: Union[str, None] = '528871a6865e'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('chats', sa.Column('latest_message_id', sa.Integer(), nullable=True, comment='最新メッセージID'))
+    op.add_column('chats', sa.Column('latest_send_at', sa.TIMESTAMP(timezone=True), nullable=True, comment='最新メッセージ送信日時'))
+    op.add_column('chats', sa.Column('message_count', sa.Integer(), server_default=sa.text('0'), nullable=False, comment='メッセージ数'))
+    op.create_index(op.f('ix_chats_latest_send_at'), 'chats', ['latest_send_at'], unique=False)
+    # 既存のチャットの集計値を埋める(メッセージIDは送信順に採番されるため最大のIDを最新とする)
+    op.execute(
+        """
+        UPDATE chats
+        JOIN (
+            SELECT chat_id, COUNT(*) AS message_count, MAX(id) AS latest_message_id
+            FROM chat_messages
+            GROUP BY chat_id
+        ) AS summary ON summary.chat_id = chats.id
+        JOIN chat_messages AS latest ON latest.id = summary.latest_message_id
+        SET
+            chats.latest_message_id = latest.id,
+            chats.latest_send_at = latest.send_at,
+            chats.message_count = summary.message_count
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_chats_latest_send_at'), table_name='chats')
+    op.drop_column('chats', 'message_count')
+    op.drop_column('chats', 'latest_send_at')
+    op.drop_column('chats', 'latest_message_id')
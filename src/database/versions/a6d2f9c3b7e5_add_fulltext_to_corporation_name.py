@@ -0,0 +1,36 @@
+"""add_fulltext_to_corporation_name
+
+Revision ID: a6d2f9c3b7e5
+Revises: 3f8b2d6a9e41
+Create Date: 2026-10-18 14:12:40.381925
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a6d2f9c3b7e5'
+down_revision: Union[str, None] = '3f8b2d6a9e41'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # ngramパーサーはストップワード("a"・"i"など)を含むngramを登録しないため、英字の企業名も探せるよう無効にして作成する
+    op.execute("SET SESSION innodb_ft_enable_stopword = OFF")
+    op.create_index(
+        'ft_corporations_name',
+        'corporations',
+        ['name'],
+        unique=False,
+        mysql_prefix='FULLTEXT',
+        mysql_with_parser='ngram',
+    )
+    op.execute("SET SESSION innodb_ft_enable_stopword = ON")
+
+
+def downgrade() -> None:
+    op.drop_index('ft_corporations_name', table_name='corporations')
@@ -0,0 +1,38 @@
+"""add_indexes_for_chat_queries
+
+Revision ID: c4f1a8e2d7b9
+Revises: 7b3e5d91c2a4
+Create Date: 2026-10-18 11:02:18.639204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4f1a8e2d7b9'
+down_revision: Union[str, None] = '7b3e5d91c2a4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # users.email・各テーブルのuuidは一意制約のインデックスがあるため追加しない
+    op.create_index('ix_chats_uuid', 'chats', ['uuid'], unique=False)
+    op.create_index('ix_chat_messages_chat_id_send_at', 'chat_messages', ['chat_id', 'send_at'], unique=False)
+    op.create_index('ix_chat_messages_chat_id_sender_id', 'chat_messages', ['chat_id', 'sender', 'id'], unique=False)
+    op.create_index('ix_chat_reads_message_id_user_id', 'chat_reads', ['message_id', 'user_id'], unique=False)
+    op.create_index(op.f('ix_users_refresh_token'), 'users', ['refresh_token'], unique=False)
+
+
+def downgrade() -> None:
+    # 外部キー用の暗黙のインデックスは複合インデックス作成時にMySQLが削除しているため、先に作り直す
+    op.create_index('chat_id', 'chat_messages', ['chat_id'], unique=False)
+    op.create_index('message_id', 'chat_reads', ['message_id'], unique=False)
+    op.drop_index(op.f('ix_users_refresh_token'), table_name='users')
+    op.drop_index('ix_chat_reads_message_id_user_id', table_name='chat_reads')
+    op.drop_index('ix_chat_messages_chat_id_sender_id', table_name='chat_messages')
+    op.drop_index('ix_chat_messages_chat_id_send_at', table_name='chat_messages')
+    op.drop_index('ix_chats_uuid', table_name='chats')
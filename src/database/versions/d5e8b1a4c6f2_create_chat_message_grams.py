@@ -0,0 +1,72 @@
+"""create_chat_message_grams
+
+Revision ID: d5e8b1a4c6f2
+Revises: a6d2f9c3b7e5
+Create Date: 2026-10-18 15:03:27.514802
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+from src.core.ngram import bigrams
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd5e8b1a4c6f2'
+down_revision: Union[str, None] = 'a6d2f9c3b7e5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# 既存メッセージを登録する際に1度に読み込むメッセージ数
+BACKFILL_BATCH_SIZE = 1000
+
+
+def upgrade() -> None:
+    op.create_table('chat_message_grams',
+    sa.Column('corporation_id', sa.Integer(), nullable=False, comment='企業ID'),
+    sa.Column('gram', mysql.VARCHAR(length=2, collation='utf8mb4_bin'), nullable=False, comment='本文のngram(正規化済み)'),
+    sa.Column('message_id', sa.Integer(), nullable=False, comment='メッセージID'),
+    sa.ForeignKeyConstraint(['corporation_id'], ['corporations.id'], ),
+    sa.ForeignKeyConstraint(['message_id'], ['chat_messages.id'], ),
+    sa.PrimaryKeyConstraint('corporation_id', 'gram', 'message_id')
+    )
+    # 既存メッセージをメッセージIDの順に一定件数ずつ登録する(ngramへの分割はアプリと同じ処理で行う)
+    grams = sa.table(
+        'chat_message_grams',
+        sa.column('corporation_id', sa.Integer),
+        sa.column('gram', sa.String),
+        sa.column('message_id', sa.Integer),
+    )
+    bind = op.get_bind()
+    last_id = 0
+    while True:
+        messages = bind.execute(
+            sa.text(
+                """
+                SELECT chat_messages.id, chat_messages.body, chats.corporation_id
+                FROM chat_messages
+                JOIN chats ON chats.id = chat_messages.chat_id
+                WHERE chat_messages.id > :last_id
+                ORDER BY chat_messages.id
+                LIMIT :limit
+                """
+            ),
+            {"last_id": last_id, "limit": BACKFILL_BATCH_SIZE},
+        ).all()
+        if not messages:
+            break
+        rows = [
+            {"corporation_id": corporation_id, "gram": gram, "message_id": id}
+            for id, body, corporation_id in messages
+            for gram in bigrams(body)
+        ]
+        if rows:
+            bind.execute(grams.insert(), rows)
+        last_id = messages[-1].id
+
+
+def downgrade() -> None:
+    op.drop_table('chat_message_grams')
@@ -0,0 +1,45 @@
+"""send_at_microseconds
+
+Revision ID: e2a9c6f4b813
+Revises: c4f1a8e2d7b9
+Create Date: 2026-10-18 11:48:05.217730
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+# revision identifiers, used by Alembic.
+revision: str = 'e2a9c6f4b813'
+down_revision: Union[str, None] = 'c4f1a8e2d7b9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # カーソルで(送信日時, ID)を比較するため、送信日時をマイクロ秒まで保存する
+    op.alter_column('chat_messages', 'send_at',
+               existing_type=mysql.TIMESTAMP(),
+               type_=mysql.TIMESTAMP(fsp=6),
+               existing_nullable=False,
+               existing_comment='送信日時')
+    op.alter_column('chats', 'latest_send_at',
+               existing_type=mysql.TIMESTAMP(),
+               type_=mysql.TIMESTAMP(fsp=6),
+               existing_nullable=True,
+               existing_comment='最新メッセージ送信日時')
+
+
+def downgrade() -> None:
+    op.alter_column('chats', 'latest_send_at',
+               existing_type=mysql.TIMESTAMP(fsp=6),
+               type_=mysql.TIMESTAMP(),
+               existing_nullable=True,
+               existing_comment='最新メッセージ送信日時')
+    op.alter_column('chat_messages', 'send_at',
+               existing_type=mysql.TIMESTAMP(fsp=6),
+               type_=mysql.TIMESTAMP(),
+               existing_nullable=False,
+               existing_comment='送信日時')
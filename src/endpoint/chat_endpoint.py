@@ -1,19 +1,27 @@
 import json
-from fastapi import APIRouter, Depends, HTTPException, WebSocket
+import os
+from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect, status
+from pydantic import ValidationError
 from src.schema.response.base_response import JsonResponse
-from src.schema.request.chat_request import ChatReadRequest, ChatSaveMessageRequest
+from src.schema.request.chat_request import ChatReadRequest, ChatSaveMessageRequest, ChatWsMessageRequest
 from src.service.corporation_service import CorporationService
-from src.core.logging import log, log_error
-from src.schema.response.chat_response import ChatIndexResponse, ChatShowResponse
+from src.core.logging import log_error
+from src.schema.response.chat_response import ChatIndexResponse, ChatSearchResponse, ChatShowResponse
 from src.service.chat_service import ChatService
 from src.core.auth import get_current_active_user, get_current_user_ws
 from src.model.user import Users
 from src.core.ws_connect import room_connection_manager, connection_manager
+from src.core.ws_heartbeat import heartbeat
+from src.core.ws_outbox import outbox
+from src.core.ws_backplane import backplane
 from src.core.dependency import di_injector
+from src.const.chat_const import ChatConsts
 
 
 router = APIRouter()
 room_connection_manager = room_connection_manager
+# WebSocket再接続時にDBから再送するメッセージの上限
+ws_resume_limit = int(os.getenv("WS_RESUME_LIMIT", "200"))
 
 @router.get(
     "/chat/index",
@@ -24,9 +32,10 @@ room_connection_manager = room_connection_manager
     operation_id="get_chats",
 )
 async def index(
-    cursor: int | None = None,
+    cursor: str | None = None,
     limit: int = 20,
     keyword: str = None,
+    unread_only: bool = False,
     current_user: Users =Depends(get_current_active_user)
 ) -> ChatIndexResponse:
     try:
@@ -34,13 +43,14 @@ async def index(
             cursor=cursor,
             limit=limit,
             keyword=keyword,
-            user_id=current_user.id
+            user_id=current_user.id,
+            unread_only=unread_only,
         )
         chats_data =  await di_injector.get_class(ChatService).chat_response_item_mapping(
             chats=chats['chats'],
             user_id=current_user.id,
         )
-        # カーソルは取得した最後のメッセージのsend_atのtimestampを返す(取得した中で一番古いもの)
+        # カーソルは取得した最後のチャットの(最新送信日時, ID)を返す(取得した中で一番古いもの)
         return ChatIndexResponse(data=chats_data, cursor=chats['next_cursor'])
     except Exception:
         raise
@@ -55,7 +65,7 @@ async def index(
 )
 async def show(
     uuid: str,
-    cursor: int | None = None,
+    cursor: str | None = None,
     limit: int = 20,
     current_user: Users =Depends(get_current_active_user)
 ) -> ChatShowResponse:
@@ -79,6 +89,32 @@ async def show(
     except Exception:
         raise
     
+@router.get(
+    "/chat/search",
+    response_model=ChatSearchResponse,
+    tags=["chat"],
+    name="チャットメッセージ検索",
+    description="企業のチャットメッセージを本文で検索します(空白区切りの語を全て含むもの・新しい順)。",
+    operation_id="search_chat_messages",
+)
+async def search(
+    corporation_uuid: str,
+    keyword: str,
+    cursor: str | None = None,
+    limit: int = 20,
+    current_user: Users =Depends(get_current_active_user)
+) -> ChatSearchResponse:
+    try:
+        result = await di_injector.get_class(ChatService).search_chat_messages(
+            corporation_uuid=corporation_uuid,
+            keyword=keyword,
+            cursor=cursor,
+            limit=limit,
+        )
+        return ChatSearchResponse(data=result['data'], cursor=result['next_cursor'])
+    except Exception:
+        raise
+
 @router.post(
     "/chat/message",
     tags=["chat"],
@@ -129,19 +165,32 @@ async def save_guest_message(request: ChatSaveMessageRequest):
 )
 async def ws_chats(
     websocket: WebSocket,
+    ping: bool = False,
 ) -> dict:
-    await connection_manager.connect(websocket)
+    # 長文のメッセージが多いため、クライアントが希望すれば圧縮して送る
+    # 死活確認はプロトコルのping(uvicornのws_ping_interval)で行う。ping=trueの場合はアプリのpingも送る
+    await connection_manager.connect(websocket, allow_compression=True, ping=ping)
     try:
+        # 初回メッセージで認証する {token: アクセストークン, corporation_uuids: 受け取る企業UUID(省略時は全企業)}
         data = await websocket.receive_text()
         parsed_data = json.loads(data)
-        if parsed_data['token']:
-            await get_current_user_ws(parsed_data['token'])
+        user = await get_current_user_ws(parsed_data.get('token'))
+        corporation_uuids = parsed_data.get('corporation_uuids')
+        if corporation_uuids is not None and (
+            not isinstance(corporation_uuids, list)
+            or not all(isinstance(uuid, str) for uuid in corporation_uuids)
+        ):
+            raise ValueError("corporation_uuidsは企業UUIDの配列で指定してください。")
+        connection_manager.subscribe(websocket, user.id, corporation_uuids)
         while True:
-            data = await websocket.receive_text()
-            await connection_manager.broadcast(data)
+            # 配信専用の接続のため、クライアントからのメッセージ(pongなど)は受信の記録だけして読み捨てる
+            await websocket.receive_text()
+            connection_manager.touch(websocket)
+    except WebSocketDisconnect:
+        pass
     except HTTPException as e:
         log_error(e)
-        raise
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
     except Exception as e:
         log_error(e)
         raise
@@ -158,24 +207,113 @@ async def ws_message(
     websocket: WebSocket,
     corporation_uuid: str,
     chat_uuid: str,
+    batch: bool = False,
+    last_uuid: str | None = None,
+    ping: bool = False,
 ) -> dict:
-    try:
-        # 初回処理
-        is_exisit = await di_injector.get_class(CorporationService).check_uuid(uuid=corporation_uuid)
-        if not is_exisit:
-            raise # 法人が存在しない場合はエラー
+    # 初回処理
+    is_exisit = await di_injector.get_class(CorporationService).check_uuid(uuid=corporation_uuid)
+    if not is_exisit:
+        # 法人が存在しない場合は接続を拒否する
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
 
-        # ここから通信処理
-        await room_connection_manager.connect(websocket, chat_uuid)
-        
-        log(room_connection_manager.active_connections)
+    # ここから通信処理
+    # batch=trueで接続した場合、短時間に続いたメッセージは配列1つのフレームにまとめて届く
+    # last_uuid(最後に受け取ったメッセージUUID)を指定して再接続した場合、それ以降のメッセージが先に届く
+    # ping=trueで接続した場合、{"type": "ping"}が届くので何かを送り返す(応答がなければ切断する)
+    await room_connection_manager.connect(
+        websocket,
+        chat_uuid,
+        corporation_uuid,
+        batch=batch,
+        allow_compression=True,
+        last_uuid=last_uuid,
+        load_missed=load_missed_messages,
+        ping=ping,
+    )
+    try:
         while True: 
             data = await websocket.receive_text()
-            await room_connection_manager.broadcast(data, chat_uuid)
-    except Exception:
-        room_connection_manager.disconnect(websocket, chat_uuid)
-        raise
+            room_connection_manager.touch(websocket)
+            try:
+                parsed_data = json.loads(data)
+            except ValueError:
+                continue
+            if not isinstance(parsed_data, dict):
+                continue
+            # 企業側ユーザーの認証 {type: "auth", token: アクセストークン} (送らない場合はゲストとして扱う)
+            if parsed_data.get('type') == 'auth':
+                user = await get_current_user_ws(parsed_data.get('token'))
+                room_connection_manager.authenticate(websocket, user.id)
+            # メッセージ送信 {type: "message", body: メッセージ内容, client_id: 送信側の識別子}
+            elif parsed_data.get('type') == 'message':
+                await receive_room_message(websocket, corporation_uuid, chat_uuid, parsed_data)
+            # 入力中状態 {type: "input", is_typing: 入力中かどうか}
+            elif parsed_data.get('type') == 'input':
+                user_id = room_connection_manager.user_id(websocket)
+                await room_connection_manager.input_broadcast(
+                    {
+                        'type': 'input',
+                        'sender': ChatConsts.SENDER_USER if user_id is not None else ChatConsts.SENDER_GUEST,
+                        'user_id': user_id,
+                        'is_typing': bool(parsed_data.get('is_typing', True)),
+                    },
+                    chat_uuid,
+                )
+    except WebSocketDisconnect:
+        pass
+    except HTTPException as e:
+        log_error(e)
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+    finally:
+        room_connection_manager.disconnect(websocket)
     
+async def load_missed_messages(chat_uuid: str, last_uuid: str) -> list:
+    """再接続時、メモリ上の履歴で足りない分のメッセージをDBから取得する"""
+    return await di_injector.get_class(ChatService).get_missed_messages(
+        chat_uuid=chat_uuid,
+        last_uuid=last_uuid,
+        limit=ws_resume_limit,
+    )
+
+async def receive_room_message(websocket: WebSocket, corporation_uuid: str, chat_uuid: str, parsed_data: dict):
+    """部屋のWebSocketで受け取ったメッセージを保存し、送信者に受付通知を返してから配信する
+
+    受付通知 {type: "ack", client_id: 送信側の識別子, uuid: メッセージUUID}
+    失敗時 {type: "error", client_id: 送信側の識別子, message: エラー内容}
+    """
+    client_id = parsed_data.get('client_id') if isinstance(parsed_data.get('client_id'), str) else None
+    try:
+        request = ChatWsMessageRequest.model_validate(parsed_data)
+    except ValidationError as e:
+        room_connection_manager.send(
+            websocket,
+            {'type': 'error', 'client_id': client_id, 'message': e.errors()[0]['msg']},
+        )
+        return
+    user_id = room_connection_manager.user_id(websocket)
+    chat_service = di_injector.get_class(ChatService)
+    try:
+        message = await chat_service.save_room_message(
+            chat_uuid=chat_uuid,
+            corporation_uuid=corporation_uuid,
+            body=request.body,
+            user_id=user_id,
+        )
+    except Exception as e:
+        log_error(e)
+        room_connection_manager.send(
+            websocket,
+            {'type': 'error', 'client_id': request.client_id, 'message': 'メッセージの保存に失敗しました。'},
+        )
+        return
+    room_connection_manager.send(
+        websocket,
+        {'type': 'ack', 'client_id': request.client_id, 'uuid': message.uuid},
+    )
+    await chat_service.message_broadcast(message)
+
 @router.post(
     "/chat/read",
     tags=["chat"],
@@ -196,4 +334,28 @@ async def read_message(
 
         return JsonResponse()
     except Exception:
-        raise
\ No newline at end of file
+        raise
+
+@router.get(
+    "/chat/ws-stats",
+    tags=["chat"],
+    response_model=JsonResponse,
+    name="WebSocket配信状況取得",
+    description="WebSocketの接続数と送信キュー・outboxのカウンター(破棄・切断数、配信待ちなど)を取得します。",
+    operation_id="get_ws_stats",
+)
+async def ws_stats(
+    current_user: Users =Depends(get_current_active_user)
+) -> JsonResponse:
+    try:
+        return JsonResponse(
+            data={
+                "chat": connection_manager.stats(),
+                "room": room_connection_manager.stats(),
+                "heartbeat": heartbeat.stats(),
+                "outbox": outbox.stats(),
+                "backplane": backplane.stats(),
+            }
+        )
+    except Exception:
+        raise
@@ -1,19 +1,42 @@
 from datetime import datetime, timezone
 from typing import TYPE_CHECKING, Optional, List
-from sqlalchemy import TIMESTAMP
-from sqlmodel import Field, SQLModel, Column, Integer, String, ForeignKey, Relationship
+from sqlalchemy import TIMESTAMP, Index
+from sqlalchemy.dialects import mysql
+from sqlalchemy.orm import query_expression
+from sqlmodel import Field, SQLModel, Column, Integer, String, ForeignKey, Relationship, text
 from src.model.corporation import Corporations
 from src.model.chat_message import ChatMessages
+from src.model.chat_read_watermark import ChatReadWatermarks
 if TYPE_CHECKING:
     from src.model.user import Users
 
 class Chats(SQLModel, table=True):
+    __table_args__ = (
+        # チャットはどこからもuuidで引く(iframeで先行生成するため一意制約は付けていない)
+        Index("ix_chats_uuid", "uuid"),
+    )
     id: Optional[int] = Field(default=None, sa_column=Column(Integer, primary_key=True, comment="ID"))
     uuid: str = Field(
         Field(sa_column=Column(String(36), nullable=False, comment="UUID uuidが先行で作成されるので自動生成はしない"))
     )
     user_id: int = Field(sa_column=Column(Integer, ForeignKey("users.id"), nullable=True, comment="ユーザID"))
     corporation_id: int = Field(sa_column=Column(Integer, ForeignKey("corporations.id"), nullable=False, comment="企業ID"))
+    # 一覧の並び替え用にメッセージ保存時に更新する集計値(chat_messagesとの循環参照を避けるため外部キーは張らない)
+    latest_message_id: Optional[int] = Field(
+        default=None, sa_column=Column(Integer, nullable=True, comment="最新メッセージID")
+    )
+    latest_send_at: Optional[datetime] = Field(
+        default=None,
+        sa_column=Column(
+            TIMESTAMP(True).with_variant(mysql.TIMESTAMP(timezone=True, fsp=6), "mysql"),
+            nullable=True,
+            index=True,
+            comment="最新メッセージ送信日時",
+        ),
+    )
+    message_count: int = Field(
+        default=0, sa_column=Column(Integer, nullable=False, server_default=text("0"), comment="メッセージ数")
+    )
     created_at: datetime = Field(
         default_factory=lambda: datetime.now(timezone.utc),
         sa_column=Column(
@@ -32,4 +55,17 @@ class Chats(SQLModel, table=True):
     )
     user: "Users" = Relationship(back_populates="chats")
     corporation: Corporations = Relationship(back_populates="chats")
-    messages: List[ChatMessages] = Relationship(back_populates="chat") # type: ignore
\ No newline at end of file
+    messages: List[ChatMessages] = Relationship(back_populates="chat") # type: ignore
+    read_watermarks: List[ChatReadWatermarks] = Relationship(back_populates="chat") # type: ignore
+    # 一覧表示用の最新メッセージ(latest_message_idから引く。読み取り専用)
+    latest_message: Optional[ChatMessages] = Relationship(
+        sa_relationship_kwargs={
+            "primaryjoin": "foreign(Chats.latest_message_id) == ChatMessages.id",
+            "uselist": False,
+            "viewonly": True,
+        }
+    )
+
+
+# 未読数(クエリ側でwith_expressionにより取得する。取得しない場合はNone)
+Chats.unread_count = query_expression()
\ No newline at end of file
@@ -1,15 +1,21 @@
 from datetime import datetime, timezone
-from typing import TYPE_CHECKING, Optional, List
+from typing import TYPE_CHECKING, Optional
 from uuid import uuid4
-from sqlalchemy import TIMESTAMP
+from sqlalchemy import TIMESTAMP, Index
+from sqlalchemy.dialects import mysql
 from sqlmodel import Field, SQLModel, Column, Integer, String, Text, ForeignKey, Relationship
 if TYPE_CHECKING:
     from src.model.user import Users
     from src.model.chat import Chats
-    from src.model.chat_reads import ChatsRead
 
 class ChatMessages(SQLModel, table=True):
     __tablename__ = "chat_messages"
+    __table_args__ = (
+        # チャット詳細の送信日時順の取得
+        Index("ix_chat_messages_chat_id_send_at", "chat_id", "send_at"),
+        # 既読判定・既読処理でのゲストのメッセージの取得
+        Index("ix_chat_messages_chat_id_sender_id", "chat_id", "sender", "id"),
+    )
     id: Optional[int] = Field(default=None, sa_column=Column(Integer, primary_key=True, comment="ID"))
     uuid: str = Field(
         default_factory=lambda: str(uuid4()), sa_column=Column(String(36), nullable=False, unique=True, comment="UUID")
@@ -18,7 +24,14 @@ class ChatMessages(SQLModel, table=True):
     user_id: int = Field(sa_column=Column(Integer, ForeignKey("users.id"), nullable=True, comment="ユーザID"))
     sender: int = Field(sa_column=Column(Integer, nullable=False, comment="送信者 1:企業回答者(ユーザー) 2:チャット質問者(ゲスト)"))
     body: str = Field(sa_column=Column(Text, nullable=False, comment="メッセージ内容"))
-    send_at: datetime = Field(sa_column=Column(TIMESTAMP(True), nullable=False, comment="送信日時"))
+    # 同じ秒に送られたメッセージも順序付けできるようマイクロ秒まで保存する
+    send_at: datetime = Field(
+        sa_column=Column(
+            TIMESTAMP(True).with_variant(mysql.TIMESTAMP(timezone=True, fsp=6), "mysql"),
+            nullable=False,
+            comment="送信日時",
+        )
+    )
     created_at: datetime = Field(
         default_factory=lambda: datetime.now(timezone.utc),
         sa_column=Column(
@@ -36,5 +49,4 @@ class ChatMessages(SQLModel, table=True):
         )
     )
     chat: "Chats" = Relationship(back_populates="messages") # type: ignore
-    user: "Users" = Relationship(back_populates="chat_messages") # type: ignore
-    chat_read: List["ChatsRead"] = Relationship(back_populates="message") # type: ignore
\ No newline at end of file
+    user: "Users" = Relationship(back_populates="chat_messages") # type: ignore
\ No newline at end of file
@@ -0,0 +1,26 @@
+from sqlalchemy import String
+from sqlalchemy.dialects import mysql
+from sqlmodel import Field, SQLModel, Column, Integer, ForeignKey
+
+
+class ChatMessageGrams(SQLModel, table=True):
+    """チャットメッセージ本文の検索用の転置インデックス
+
+    メッセージ本文の2文字ずつのngramごとに1行を持つ。
+    企業ごと・ngramごとにメッセージIDの降順で辿れるよう(企業ID, ngram, メッセージID)を主キーにする。
+    """
+    __tablename__ = "chat_message_grams"
+    corporation_id: int = Field(
+        sa_column=Column(Integer, ForeignKey("corporations.id"), primary_key=True, comment="企業ID")
+    )
+    # 照合順序で濁点・大文字小文字などを同一視すると主キーが重複するため、バイナリで比較する
+    gram: str = Field(
+        sa_column=Column(
+            String(2).with_variant(mysql.VARCHAR(2, collation="utf8mb4_bin"), "mysql"),
+            primary_key=True,
+            comment="本文のngram(正規化済み)",
+        )
+    )
+    message_id: int = Field(
+        sa_column=Column(Integer, ForeignKey("chat_messages.id"), primary_key=True, comment="メッセージID")
+    )
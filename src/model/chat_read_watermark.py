@@ -0,0 +1,39 @@
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Optional
+from sqlalchemy import TIMESTAMP, UniqueConstraint
+from sqlmodel import Field, SQLModel, Column, Integer, ForeignKey, Relationship
+if TYPE_CHECKING:
+    from src.model.user import Users
+    from src.model.chat import Chats
+
+class ChatReadWatermarks(SQLModel, table=True):
+    """チャットごと・ユーザーごとの既読位置
+
+    このメッセージID以下のメッセージを既読とする。既読処理は1行のupsertで行う。
+    """
+    __tablename__ = "chat_read_watermarks"
+    __table_args__ = (
+        UniqueConstraint("chat_id", "user_id", name="uq_chat_read_watermarks_chat_id_user_id"),
+    )
+    id: Optional[int] = Field(default=None, sa_column=Column(Integer, primary_key=True, comment="ID"))
+    chat_id: int = Field(sa_column=Column(Integer, ForeignKey("chats.id"), nullable=False, comment="チャットID"))
+    user_id: int = Field(sa_column=Column(Integer, ForeignKey("users.id"), nullable=False, comment="ユーザID"))
+    last_read_message_id: int = Field(sa_column=Column(Integer, nullable=False, comment="既読にした最後のメッセージID"))
+    created_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_column=Column(
+            TIMESTAMP(True),
+            nullable=True,
+            default=datetime.now(timezone.utc)
+        )
+    )
+    updated_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_column=Column(
+            TIMESTAMP(True),
+            nullable=True,
+            onupdate=datetime.now(timezone.utc)
+        )
+    )
+    user: "Users" = Relationship(back_populates="chat_read_watermarks")
+    chat: "Chats" = Relationship(back_populates="read_watermarks")
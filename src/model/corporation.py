@@ -2,10 +2,15 @@
 from datetime import datetime, timezone
 from typing import Optional
 from uuid import uuid4
+from sqlalchemy import Index
 from sqlmodel import SQLModel, Field, Column, Integer, String, TIMESTAMP, Relationship
 
 
 class Corporations(SQLModel, table=True):
+    __table_args__ = (
+        # 企業名のキーワード検索(日本語も扱えるようngramパーサーを使う)
+        Index("ft_corporations_name", "name", mysql_prefix="FULLTEXT", mysql_with_parser="ngram"),
+    )
     id: Optional[int] = Field(default=None, sa_column=Column(Integer, primary_key=True, comment="ID"))
     uuid: str = Field(
         default_factory=lambda: str(uuid4()), sa_column=Column(String(36), nullable=False, unique=True, comment="UUID")
@@ -6,7 +6,7 @@ from sqlmodel import Field, SQLModel, Boolean, Column, Integer, String, Relation
 # if TYPE_CHECKING:
 from src.model.chat import Chats
 from src.model.chat_message import ChatMessages
-from src.model.chat_reads import ChatsRead
+from src.model.chat_read_watermark import ChatReadWatermarks
 
 
 class Users(SQLModel, table=True):
@@ -22,7 +22,7 @@ class Users(SQLModel, table=True):
             Boolean, nullable=False, default=True, comment="アクティブフラグ True:ログイン中 False:ログアウト中"
         )
     )
-    refresh_token: str = Field(sa_column=Column(String(100), nullable=True, comment="リフレッシュトークン"))
+    refresh_token: str = Field(sa_column=Column(String(100), nullable=True, index=True, comment="リフレッシュトークン"))
     expires_at: datetime = Field(sa_column=Column(TIMESTAMP(True), nullable=True, comment="リフレッシュトークン有効期限"))
     deleted_at: datetime = Field(sa_column=Column(TIMESTAMP(True), nullable=True, comment="削除日時"))
     created_at: datetime = Field(
@@ -43,4 +43,4 @@ class Users(SQLModel, table=True):
     )
     chats: List[Chats] = Relationship(back_populates="user") # type: ignore
     chat_messages: List[ChatMessages] = Relationship(back_populates="user") # type: ignore
-    chat_read: List[ChatsRead] = Relationship(back_populates="user") # type: ignore
\ No newline at end of file
+    chat_read_watermarks: List[ChatReadWatermarks] = Relationship(back_populates="user") # type: ignore
\ No newline at end of file
@@ -1,18 +1,45 @@
-from datetime import datetime
-from typing import List
-from uuid import uuid4
+import os
+from datetime import datetime, timezone
+from typing import Dict, List, NamedTuple, Optional, Tuple
 from injector import inject
-from sqlalchemy import desc, func
+from sqlalchemy import and_, case, desc, func, insert, or_, tuple_, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from sqlalchemy.future import select
-from sqlalchemy import not_, exists
-from src.model.chat_reads import ChatsRead
+from src.model.chat_read_watermark import ChatReadWatermarks
 from src.const.chat_const import ChatConsts
 from src.model.corporation import Corporations
-from src.core.logging import log
+from src.repository.corporation_repository import CorporationRepository
+from src.core.cursor import decode_cursor, encode_cursor
+from src.core.ngram import bigrams
+from src.core.lru_cache import LRUCache
+from src.core.group_commit import GroupCommitBuffer
 from src.model.chat_message import ChatMessages
+from src.model.chat_message_gram import ChatMessageGrams
 from src.model.chat import Chats
+from src.model.user import Users
 from src.database.database import DatabaseConnection
-from sqlalchemy.orm import joinedload, aliased
+from sqlalchemy.orm import joinedload, aliased, with_expression
+from sqlalchemy.orm.attributes import set_committed_value
+
+
+class ChatKey(NamedTuple):
+    id: int
+    corporation_id: int
+
+
+# チャットUUID -> ChatKey (UUIDと紐づくIDは変わらないので、存在するものは期限なしでキャッシュする)
+chat_key_cache: LRUCache[ChatKey] = LRUCache(int(os.getenv("CHAT_KEY_CACHE_SIZE", "10000")))
+
+# 既存チャットへのゲストのメッセージを、同時に届いたものとまとめて1回のINSERTとcommitで保存するかどうか
+chat_message_group_commit = os.getenv("CHAT_MESSAGE_GROUP_COMMIT", "0") == "1"
+# ゲストのメッセージのグループコミット用バッファ(最初の利用時に作成する)
+message_buffer: Optional[GroupCommitBuffer[ChatMessages, ChatMessages]] = None
+
+# メッセージ検索で転置インデックスを結合するngramの上限(長いキーワードは残りを本文の確認だけで絞り込む)
+chat_search_max_grams = int(os.getenv("CHAT_SEARCH_MAX_GRAMS", "8"))
+# 辿り始めるngramを選ぶ際に数える件数の上限
+chat_search_count_limit = int(os.getenv("CHAT_SEARCH_COUNT_LIMIT", "10000"))
+
 
 class ChatRepository:
     @inject
@@ -31,170 +58,384 @@ class ChatRepository:
             result = await session.exec(q)
             return result.scalars().first()
         
+    # chatのuuidからIDと企業IDだけを取得(キャッシュあり)
+    # まだ作成されていないチャット(iframeでuuidを先行生成している)はキャッシュせず、作成後に引けるようにする
+    async def resolve_chat(self, uuid: str) -> Optional[ChatKey]:
+        key = chat_key_cache.get(uuid)
+        if key is not None:
+            return key
+        async with self.db.get_db() as session:
+            result = await session.exec(
+                select(Chats.id, Chats.corporation_id).where(Chats.uuid == uuid).limit(1)
+            )
+            row = result.first()
+            if row is None:
+                return None
+            key = ChatKey(row.id, row.corporation_id)
+            chat_key_cache.put(uuid, key)
+            return key
+
     # chat一覧取得
     async def get_chats(
         self,
-        cursor: int | None,
+        cursor: str | None,
         limit: int,
         keyword: str | None,
         user_id: int | None = None,
+        unread_only: bool = False,
     ) -> List[Chats]:
         async with self.db.get_db() as session:
-            # 並び替えのためにサブクエリを作成
             query = await self.get_chat_query(user_id)
-            if cursor is None or cursor == 0:
-                q = query['query'].limit(limit)
-            else:
-                # cursorをdatetime型に変換
-                cursor = datetime.fromtimestamp(cursor)
-                q = query['query'].where(query['sub_query'].c.latest_send_at < cursor).limit(limit)
+            q = query['query'].limit(limit)
+            if unread_only:
+                q = q.where(query['unread_count'] > 0)
+            if cursor and cursor != "0":
+                # (latest_send_at, id)の行値比較でカーソルより後の行だけを取得する
+                send_at, id = decode_cursor(cursor)
+                if id is None:
+                    q = q.where(Chats.latest_send_at < send_at)
+                else:
+                    q = q.where(tuple_(Chats.latest_send_at, Chats.id) < tuple_(send_at, id))
                 
-            if keyword:
-                q = q.where(Chats.corporation.has(Corporations.name.like(f"%{keyword}%")))
+            if keyword and keyword.strip():
+                # 企業名で検索した企業IDで絞り込む(企業ごとのEXISTSではなくFULLTEXTインデックスで企業を探す)
+                q = q.where(Chats.corporation_id.in_(CorporationRepository.name_search_query(keyword)))
             result = await session.exec(q)
             chats = result.scalars().unique().all()
-            next_cursor = int(chats[-1].messages[0].send_at.timestamp()) if chats else None
+            next_cursor = encode_cursor(chats[-1].latest_send_at, chats[-1].id) if chats else None
             return {"chats": chats, "next_cursor": next_cursor}
         
     # chat取得クエリ
     async def get_chat_query(self, user_id: int | None = None):
-        ChatMessagesAlias = aliased(ChatMessages)
-        sub_query = (
-            select(ChatMessagesAlias.chat_id, func.max(ChatMessagesAlias.send_at).label('latest_send_at'))
-            .group_by(ChatMessagesAlias.chat_id)
-            .subquery()
-        )
-        
+        # メッセージ保存時に更新しているlatest_send_at(インデックスあり)で並び替える(同時刻はIDの降順)
+        # メッセージのないチャットは一覧に出さない
+        # 全メッセージは読み込まず、最新メッセージ1件と未読数だけを取得する
+        unread_count = self.unread_count_expression(user_id)
         query = (
             select(Chats)
-            .join(sub_query, Chats.id == sub_query.c.chat_id)
             .options(
                 joinedload(Chats.user),
                 joinedload(Chats.corporation),
-                joinedload(Chats.messages).joinedload(ChatMessages.chat_read, innerjoin=False),
+                joinedload(Chats.latest_message),
+                with_expression(Chats.unread_count, unread_count),
             )
-            .order_by(desc(sub_query.c.latest_send_at))
+            .where(Chats.latest_message_id.isnot(None))
+            .order_by(desc(Chats.latest_send_at), desc(Chats.id))
         )
+        return {'query': query, 'unread_count': unread_count}
+
+    # 未読数(ユーザーの既読位置より後のゲストのメッセージ数。(chat_id, sender, id)のインデックスの範囲で数える)
+    def unread_count_expression(self, user_id: int | None):
+        last_read_message_id = (
+            select(ChatReadWatermarks.last_read_message_id)
+            .where(ChatReadWatermarks.chat_id == Chats.id)
+            .where(ChatReadWatermarks.user_id == user_id)
+            .correlate(Chats)
+            .scalar_subquery()
+        )
+        query = (
+            select(func.count(ChatMessages.id))
+            .where(ChatMessages.chat_id == Chats.id)
+            .where(ChatMessages.sender == ChatConsts.SENDER_GUEST)
+            .correlate(Chats)
+        )
+        # ユーザーを指定しない場合は既読位置がないため、ゲストのメッセージを全て数える
+        if user_id is not None:
+            query = query.where(ChatMessages.id > func.coalesce(last_read_message_id, 0))
+        return query.scalar_subquery()
         
-        query = query.order_by(desc(sub_query.c.latest_send_at))
-        return {'query': query, 'sub_query': sub_query}
-        
-        
-    # chat作成
-    async def create_chat(
-        self,
-        corporation_uuid: str,
-        uuid: str | None,
-        user_id: int | None,
-    ) -> Chats:
-        async with self.db.get_db() as session:
-            chat = Chats(
-                uuid=uuid if uuid else str(uuid4()),
-                corporation_id=corporation_uuid,
-                user_id=user_id,
-            )
-            session.add(chat)
-            await session.commit()
-            await session.refresh(chat)
-            chat = await session.execute(
-                select(Chats)
-                .options(
-                    joinedload(Chats.user),
-                    joinedload(Chats.corporation),
-                    joinedload(Chats.messages),
-                )
-                .where(Chats.id == chat.id)
-            )
-            chat = chat.unique().scalar_one()
-            log(chat)
-            return chat
-            
-    
     # chatのメッセージ一覧取得
-    async def get_chat_messages(self, chat_uuid: str, cursor: int | None, limit: int) -> List[ChatMessages]:
+    async def get_chat_messages(self, chat_uuid: str, cursor: str | None, limit: int) -> List[ChatMessages]:
+        chat = await self.resolve_chat(chat_uuid)
+        if chat is None:
+            return {"messages": [], "next_cursor": None}
         async with self.db.get_db() as session:
-            chat = await self.get_chat_by_uuid(chat_uuid)
             chat_id = chat.id
             
-            if cursor is None or cursor == 0:
-                query = (
-                    select(ChatMessages)
-                    .options(
-                        joinedload(ChatMessages.user),
-                    )
-                    .where(ChatMessages.chat_id == chat_id)
-                    .order_by(desc(ChatMessages.send_at))
-                    .limit(limit)
-                )
-            else:
-                cursor = datetime.fromtimestamp(cursor)
-                query = (
-                    select(ChatMessages)
-                    .options(
-                        joinedload(ChatMessages.user),
-                    )
-                    .where(ChatMessages.chat_id == chat_id)
-                    .where(ChatMessages.send_at < cursor)
-                    .order_by(desc(ChatMessages.send_at))
-                    .limit(limit)
+            # (chat_id, send_at, id)のインデックス順に新しいものから取得する
+            query = (
+                select(ChatMessages)
+                .options(
+                    joinedload(ChatMessages.user),
                 )
+                .where(ChatMessages.chat_id == chat_id)
+                .order_by(desc(ChatMessages.send_at), desc(ChatMessages.id))
+                .limit(limit)
+            )
+            if cursor and cursor != "0":
+                send_at, id = decode_cursor(cursor)
+                if id is None:
+                    query = query.where(ChatMessages.send_at < send_at)
+                else:
+                    query = query.where(tuple_(ChatMessages.send_at, ChatMessages.id) < tuple_(send_at, id))
             result = await session.exec(query)
             chat_messages = result.scalars().all()
-            next_cursor = int(chat_messages[-1].send_at.timestamp()) if chat_messages else None
+            next_cursor = encode_cursor(chat_messages[-1].send_at, chat_messages[-1].id) if chat_messages else None
             return {"messages": chat_messages, "next_cursor": next_cursor}
         
-    # chatメッセージ保存
-    async def save_chat_message(
+    # 指定したメッセージより後のメッセージを古い順に取得(WebSocket再接続時の再送用、limitを超える場合は新しい方を優先)
+    async def get_chat_messages_after(self, chat_uuid: str, message_uuid: str, limit: int) -> List[ChatMessages]:
+        async with self.db.get_db() as session:
+            anchor = await session.exec(
+                select(ChatMessages.id, ChatMessages.chat_id)
+                .join(Chats, Chats.id == ChatMessages.chat_id)
+                .where(Chats.uuid == chat_uuid)
+                .where(ChatMessages.uuid == message_uuid)
+            )
+            anchor = anchor.first()
+            if anchor is None:
+                return []
+            query = (
+                select(ChatMessages)
+                .options(
+                    joinedload(ChatMessages.user),
+                )
+                .where(ChatMessages.chat_id == anchor.chat_id)
+                .where(ChatMessages.id > anchor.id)
+                .order_by(desc(ChatMessages.id))
+                .limit(limit)
+            )
+            result = await session.exec(query)
+            return list(reversed(result.scalars().all()))
+
+    # chatメッセージ送信
+    # チャットの解決(なければ作成)・メッセージのINSERT・集計値の更新・一覧配信用のチャット取得を1つのセッションとトランザクションで行う
+    # 返すメッセージのchatに一覧配信用のチャット、userに渡されたuserを入れる。企業が存在しない場合はNone
+    # グループコミットが有効な場合、既存チャットへのゲストのメッセージは同時に届いたものとまとめて保存する
+    async def send_chat_message(
         self,
-        chat_id: int,
+        chat_uuid: str,
+        corporation_uuid: str,
         sender: int,
         user_id: int | None,
-        body: str
-    ) -> ChatMessages:
+        body: str,
+        user: Users | None = None,
+    ) -> Optional[ChatMessages]:
+        if chat_message_group_commit and user_id is None:
+            key = await self.resolve_chat(chat_uuid)
+            if key is not None:
+                return await self.get_message_buffer().submit(
+                    ChatMessages(chat_id=key.id, user_id=None, sender=sender, body=body, send_at=datetime.now())
+                )
         async with self.db.get_db() as session:
+            key = chat_key_cache.get(chat_uuid)
+            if key is None:
+                result = await session.exec(
+                    select(Chats.id, Chats.corporation_id).where(Chats.uuid == chat_uuid).limit(1)
+                )
+                row = result.first()
+                key = ChatKey(row.id, row.corporation_id) if row else None
+            # まだチャットが存在しない場合は新規作成(uuidはiframeで先行生成されるためチャットがない場合がある)
+            if key is None:
+                result = await session.exec(
+                    select(Corporations.id).where(Corporations.uuid == corporation_uuid)
+                )
+                corporation_id = result.scalar()
+                if corporation_id is None:
+                    return None
+                chat = Chats(uuid=chat_uuid, corporation_id=corporation_id, user_id=user_id)
+                session.add(chat)
+                await session.flush()
+                key = ChatKey(chat.id, chat.corporation_id)
+
             chat_message = ChatMessages(
-                chat_id=chat_id,
+                chat_id=key.id,
                 user_id=user_id,
                 sender=sender,
                 body=body,
                 send_at=datetime.now()
             )
             session.add(chat_message)
-            await session.commit()
-            await session.refresh(chat_message)
-            # userを含むchat_messageを再取得
-            chat_message = await session.execute(
-                select(ChatMessages)
-                .options(joinedload(ChatMessages.user))
-                .where(ChatMessages.id == chat_message.id)
+            await session.flush()
+            await self.index_chat_messages(session, [(key.corporation_id, chat_message)])
+            # チャットの集計値をメッセージと同じトランザクションで更新する
+            await session.execute(self.chat_summary_update(key.id, chat_message, 1))
+            # 一覧の配信に使う企業・担当ユーザー・最新メッセージを取得する(全体への配信のため未読数は取得しない)
+            # (先に別の送信がcommitしていれば、最新メッセージは保存したものより新しいものになる)
+            result = await session.exec(
+                select(Chats)
+                .options(
+                    joinedload(Chats.user),
+                    joinedload(Chats.corporation),
+                    joinedload(Chats.latest_message),
+                )
+                .where(Chats.id == key.id)
+                .execution_options(populate_existing=True)
             )
-            chat_message = chat_message.scalar_one()
+            chat = result.scalars().one()
+            # commitで属性が失効して再取得されないよう、先にセッションから切り離す
+            session.expunge_all()
+            await session.commit()
+            set_committed_value(chat_message, "user", user)
+            set_committed_value(chat_message, "chat", chat)
+            chat_key_cache.put(chat_uuid, key)
             return chat_message
-        
-    async def read_chat_message(self, chat_id: int, user_id: int) -> bool:
+
+    # チャットの集計値の更新
+    # 同じチャットへの送信が保存と逆の順にcommitされても最新メッセージが古いものに戻らないよう、IDが大きい場合だけ置き換える
+    # (MySQLは左から順に代入するため、最新メッセージIDを置き換える前の値で送信日時の条件を判定する)
+    def chat_summary_update(self, chat_id: int, message: ChatMessages, count: int):
+        newer = or_(Chats.latest_message_id.is_(None), Chats.latest_message_id < message.id)
+        return (
+            update(Chats)
+            .where(Chats.id == chat_id)
+            .ordered_values(
+                (Chats.latest_send_at, case((newer, message.send_at), else_=Chats.latest_send_at)),
+                (Chats.latest_message_id, case((newer, message.id), else_=Chats.latest_message_id)),
+                (Chats.message_count, Chats.message_count + count),
+            )
+        )
+
+    # ゲストのメッセージのグループコミット用バッファ
+    def get_message_buffer(self) -> GroupCommitBuffer[ChatMessages, ChatMessages]:
+        global message_buffer
+        if message_buffer is None:
+            message_buffer = GroupCommitBuffer(self.write_chat_messages)
+        return message_buffer
+
+    # 既存チャットへのゲストのメッセージをまとめて保存(グループコミット)
+    # 複数行のINSERT1回で到着順に保存し、IDはuuidで引き直す。集計値の更新と一覧配信用のチャット取得はチャットごとにまとめて行う
+    async def write_chat_messages(self, messages: List[ChatMessages]) -> List[ChatMessages]:
+        columns = [column.name for column in ChatMessages.__table__.columns if column.name != "id"]
         async with self.db.get_db() as session:
-            subquery = (
-                select(ChatsRead)
-                .where(ChatsRead.message_id == ChatMessages.id)
-                .where(ChatsRead.user_id == user_id)
-                .correlate(ChatMessages)
+            await session.execute(
+                insert(ChatMessages).values([
+                    {column: getattr(message, column) for column in columns} for message in messages
+                ])
+            )
+            result = await session.exec(
+                select(ChatMessages.uuid, ChatMessages.id)
+                .where(ChatMessages.uuid.in_([message.uuid for message in messages]))
+            )
+            ids = dict(result.all())
+            latest: Dict[int, ChatMessages] = {}
+            counts: Dict[int, int] = {}
+            for message in messages:
+                message.id = ids[message.uuid]
+                latest[message.chat_id] = message
+                counts[message.chat_id] = counts.get(message.chat_id, 0) + 1
+            for chat_id, message in latest.items():
+                await session.execute(self.chat_summary_update(chat_id, message, counts[chat_id]))
+            result = await session.exec(
+                select(Chats)
+                .options(
+                    joinedload(Chats.user),
+                    joinedload(Chats.corporation),
+                    joinedload(Chats.latest_message),
+                )
+                .where(Chats.id.in_(list(latest)))
             )
+            chats = {chat.id: chat for chat in result.scalars().unique().all()}
+            await self.index_chat_messages(
+                session, [(chats[message.chat_id].corporation_id, message) for message in messages]
+            )
+            session.expunge_all()
+            await session.commit()
+            for message in messages:
+                set_committed_value(message, "user", None)
+                set_committed_value(message, "chat", chats[message.chat_id])
+            return messages
+
+    # メッセージ本文の検索用インデックスへの追加(メッセージの保存と同じトランザクションで行う)
+    async def index_chat_messages(self, session, messages: List[Tuple[int, ChatMessages]]):
+        rows = [
+            {"corporation_id": corporation_id, "gram": gram, "message_id": message.id}
+            for corporation_id, message in messages
+            for gram in bigrams(message.body)
+        ]
+        if rows:
+            await session.execute(insert(ChatMessageGrams).values(rows))
 
+    # メッセージ本文の検索(企業内・新しい順)
+    # 語のngramを全て持つメッセージを、最も件数の少ないngramの転置インデックスをメッセージIDの降順に辿りながら
+    # 残りのngramを主キーで確認して探し、語がそのまま本文に含まれるものだけを返す
+    async def search_chat_messages(
+        self,
+        corporation_uuid: str,
+        words: List[str],
+        cursor: str | None,
+        limit: int,
+    ) -> dict:
+        grams = list(dict.fromkeys(gram for word in words for gram in bigrams(word)))
+        # 検索用のカーソルはメッセージIDで辿るため、IDを持たない従来のカーソルは受け付けない
+        id = decode_cursor(cursor, allow_legacy=False)[1] if cursor and cursor != "0" else None
+        async with self.db.get_db() as session:
+            result = await session.exec(select(Corporations.id).where(Corporations.uuid == corporation_uuid))
+            corporation_id = result.scalar()
+            if corporation_id is None:
+                return {"messages": [], "next_cursor": None}
+            counts = await self.count_chat_message_grams(session, corporation_id, grams)
+            if min(counts.values()) == 0:
+                return {"messages": [], "next_cursor": None}
+            grams = sorted(grams, key=counts.get)[:chat_search_max_grams]
+
+            first = aliased(ChatMessageGrams)
             query = (
-                select(ChatMessages.id)
-                .outerjoin(ChatMessages.chat_read)
-                .where(ChatMessages.chat_id == chat_id)
-                .where(ChatMessages.sender == ChatConsts.SENDER_GUEST)
-                .where(not_(exists(subquery)))
+                select(ChatMessages)
+                .join(first, first.message_id == ChatMessages.id)
+                .options(joinedload(ChatMessages.chat), joinedload(ChatMessages.user))
+                .where(first.corporation_id == corporation_id)
+                .where(first.gram == grams[0])
+                .order_by(desc(first.message_id))
+                .limit(limit)
             )
-            
-            ids = await session.exec(query)
-            ids = ids.scalars().all()
-            for id in ids:
-                chat_read = ChatsRead(
-                    message_id=id,
-                    user_id=user_id,
+            for gram in grams[1:]:
+                other = aliased(ChatMessageGrams)
+                query = query.join(
+                    other,
+                    and_(
+                        other.corporation_id == first.corporation_id,
+                        other.gram == gram,
+                        other.message_id == first.message_id,
+                    ),
                 )
-                session.add(chat_read)
+            # ngramが揃っていても語として連続しているとは限らないため本文で確認する(照合順序で大文字小文字などは区別しない)
+            for word in words:
+                query = query.where(ChatMessages.body.contains(word, autoescape=True))
+            if id is not None:
+                query = query.where(first.message_id < id)
+            result = await session.exec(query)
+            messages = result.scalars().unique().all()
+            next_cursor = encode_cursor(messages[-1].send_at, messages[-1].id) if messages else None
+            return {"messages": messages, "next_cursor": next_cursor}
+
+    # ngramごとの転置インデックスの件数(1回のクエリで、ngramごとにchat_search_count_limit件まで数える)
+    # どれだけ多いかは不要で、辿り始めるngramを選べれば良いため上限で打ち切る
+    async def count_chat_message_grams(self, session, corporation_id: int, grams: List[str]) -> Dict[str, int]:
+        counts = [
+            select(func.count())
+            .select_from(
+                select(ChatMessageGrams.message_id)
+                .where(ChatMessageGrams.corporation_id == corporation_id)
+                .where(ChatMessageGrams.gram == gram)
+                .limit(chat_search_count_limit)
+                .subquery()
+            )
+            .scalar_subquery()
+            for gram in grams
+        ]
+        result = await session.execute(select(*counts))
+        return dict(zip(grams, result.one()))
+
+    # 既読位置の更新(チャットの最新メッセージまでを既読にする。チャット・ユーザーごとに1行をupsertし、既読位置は戻さない)
+    async def read_chat_message(self, chat_id: int, user_id: int) -> bool:
+        async with self.db.get_db() as session:
+            now = datetime.now(timezone.utc)
+            latest_message_id = select(Chats.latest_message_id).where(Chats.id == chat_id).scalar_subquery()
+            query = mysql_insert(ChatReadWatermarks).values(
+                chat_id=chat_id,
+                user_id=user_id,
+                last_read_message_id=func.coalesce(latest_message_id, 0),
+                created_at=now,
+                updated_at=now,
+            )
+            query = query.on_duplicate_key_update(
+                last_read_message_id=func.greatest(
+                    ChatReadWatermarks.last_read_message_id,
+                    query.inserted.last_read_message_id,
+                ),
+                updated_at=now,
+            )
+            await session.execute(query)
             await session.commit()
             return True
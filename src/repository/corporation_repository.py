@@ -1,10 +1,15 @@
 
+import os
 from injector import inject
 from sqlalchemy import select
+from sqlalchemy.dialects.mysql import match
 
 from src.model.corporation import Corporations
 from src.database.database import DatabaseConnection
 
+# MySQLのngram_token_size(FULLTEXTインデックスに登録されるngramの文字数)
+ngram_token_size = int(os.getenv("NGRAM_TOKEN_SIZE", "2"))
+
 
 class CorporationRepository:
     @inject
@@ -22,4 +27,20 @@ class CorporationRepository:
                 .where(Corporations.uuid == uuid)
             )
             result = await session.exec(query)
-            return result.scalars().first()
\ No newline at end of file
+            return result.scalars().first()
+
+    # 企業名のキーワード検索で一致する企業IDのクエリ
+    # 空白区切りの語を全て含む企業を、ngramのFULLTEXTインデックス(ft_corporations_name)の語ごとのフレーズ検索で探す
+    # ngram_token_size未満の語はインデックスで探せないため中間一致で絞り込む
+    @staticmethod
+    def name_search_query(keyword: str):
+        terms = [term for term in keyword.replace('"', " ").split() if term]
+        indexed = [term for term in terms if len(term) >= ngram_token_size]
+        query = select(Corporations.id)
+        if indexed:
+            against = " ".join(f'+"{term}"' for term in indexed)
+            query = query.where(match(Corporations.name, against=against).in_boolean_mode())
+        for term in terms:
+            if len(term) < ngram_token_size:
+                query = query.where(Corporations.name.contains(term, autoescape=True))
+        return query
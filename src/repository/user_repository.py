@@ -1,10 +1,18 @@
+import os
 from datetime import datetime
 from typing import Optional
 from injector import inject
 from sqlalchemy.future import select
+from src.core.lru_cache import LRUCache
 from src.database.database import DatabaseConnection
 from src.model.user import Users
 
+# ユーザーID -> ユーザー(メッセージの送信者表示用。アカウント名の変更はttlの間反映されない)
+user_cache: LRUCache[Users] = LRUCache(
+    int(os.getenv("USER_CACHE_SIZE", "1000")),
+    ttl=float(os.getenv("USER_CACHE_TTL", "60")),
+)
+
 class UserRepository:
     @inject
     def __init__(
@@ -20,6 +28,20 @@ class UserRepository:
             user = result.scalars().first()
             return user
         
+    # IDからユーザー取得(キャッシュあり。返すユーザーはセッションから切り離されている)
+    async def get_user_by_id(self, user_id: int) -> Optional[Users]:
+        user = user_cache.get(user_id)
+        if user is not None:
+            return user
+        async with self.db.get_db() as session:
+            result = await session.exec(select(Users).where(Users.id == user_id))
+            user = result.scalars().first()
+            if user is None:
+                return None
+            session.expunge(user)
+            user_cache.put(user_id, user)
+            return user
+
     # uuidからユーザー取得
     async def get_user_by_uuid(self, uuid: str) -> Optional[Users]:
         async with self.db.get_db() as session:
@@ -24,4 +24,27 @@ class ChatReadRequest(BaseModel):
         ...,
         title="チャットUUID",
         description="チャットUUID",
-    )
\ No newline at end of file
+    )
+
+class ChatWsMessageRequest(BaseModel):
+    """部屋のWebSocketで送るメッセージ {type: "message", body: メッセージ内容, client_id: 送信側の識別子}"""
+    body: str = Field(
+        ...,
+        min_length=1,
+        title="メッセージ内容",
+        description="メッセージ内容",
+    )
+    client_id: str | None = Field(
+        None,
+        max_length=64,
+        title="クライアントID",
+        description="送信側で採番した識別子(受付通知にそのまま返す)",
+    )
+
+    @field_validator("body")
+    @classmethod
+    def strip_body(cls, value: str) -> str:
+        value = value.strip()
+        if not value:
+            raise ValueError("メッセージ内容を入力してください。")
+        return value
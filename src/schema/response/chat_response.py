@@ -16,7 +16,10 @@ class ChatIndexResponse(JsonResponse):
         corporation_name: str
         latest_message: str
         latest_send_at: datetime
-        is_read: bool | None = Field(None, description="既読フラグ")
+        is_read: bool | None = Field(None, description="既読フラグ(企業全体へのWebSocket配信ではnull)")
+        unread_count: int | None = Field(
+            None, description="未読数(ゲストのメッセージのうち既読位置より後のもの。企業全体へのWebSocket配信ではnull)"
+        )
         class Config:
             from_attributes = True
             json_schema_extra = {
@@ -26,11 +29,12 @@ class ChatIndexResponse(JsonResponse):
                     "corporation_uuid": "uuid",
                     "latest_message": "Hello, World!",
                     "latest_send_at": "2022-01-01 00:00:00",
-                    "is_read": True
+                    "is_read": False,
+                    "unread_count": 3
                 }
             }
     data: List[ChatIndexResponseItem] = Field(None, description="チャット一覧情報")
-    cursor: int | None = Field(None, description="次のページのカーソル")
+    cursor: str | None = Field(None, description="次のページのカーソル(従来の数値のカーソルも受け付ける)")
     
 class ChatShowResponse(JsonResponse):
     class ChatShowResponseItem(SQLModel):
@@ -50,4 +54,27 @@ class ChatShowResponse(JsonResponse):
                 }
             }
     data: List[ChatShowResponseItem] = Field(None, description="チャット詳細情報")
-    cursor: int | None = Field(None, description="次のページのカーソル")
+    cursor: str | None = Field(None, description="次のページのカーソル(従来の数値のカーソルも受け付ける)")
+
+
+class ChatSearchResponse(JsonResponse):
+    class ChatSearchResponseItem(SQLModel):
+        chat_uuid: str
+        uuid: str
+        snippet: str = Field(..., description="本文のうちキーワードの前後")
+        send_at: datetime
+        sender: int
+        user: UserResponse.UserResponseItem | None
+        class Config:
+            from_attributes = True
+            json_schema_extra = {
+                "example": {
+                    "chat_uuid": "uuid",
+                    "uuid": "uuid",
+                    "snippet": "…料金プランについて質問です…",
+                    "send_at": "2022-01-01 00:00:00",
+                    "sender": 2
+                }
+            }
+    data: List[ChatSearchResponseItem] = Field(None, description="検索結果(新しい順)")
+    cursor: str | None = Field(None, description="次のページのカーソル")
@@ -1,16 +1,18 @@
 
 from operator import is_
 from typing import List
+from fastapi import HTTPException, status
 from injector import inject
 
 from src.model.chat import Chats
-from src.schema.response.chat_response import ChatIndexResponse, ChatShowResponse
-from src.repository.corporation_repository import CorporationRepository
+from src.schema.response.chat_response import ChatIndexResponse, ChatSearchResponse, ChatShowResponse
 from src.const.chat_const import ChatConsts
 from src.model.chat_message import ChatMessages
 from src.repository.chat_repository import ChatRepository
+from src.repository.user_repository import UserRepository
 from src.core.ws_connect import room_connection_manager, connection_manager
-from src.core.logging import log
+from src.core.ws_outbox import outbox
+from src.core.ngram import snippet, terms
 
 
 class ChatService:
@@ -21,23 +23,27 @@ class ChatService:
     def __init__(
         self,
         repository: ChatRepository,
-        corporation_repository: CorporationRepository,
+        user_repository: UserRepository,
     ):
         self.repository = repository
-        self.corporation_repository = corporation_repository
+        self.user_repository = user_repository
 
     async def get_chats(
         self,
-        cursor: int | None,
+        cursor: str | None,
         limit: int,
         keyword: str | None,
         user_id: int | None = None,
+        unread_only: bool = False,
     ) -> dict:
         """Get chats
         
         Args:
-            cursor (int): 前回取得時のカーソル
+            cursor (str): 前回取得時のカーソル
             limit (int): 取得数
+            keyword (str | None): 企業名の検索キーワード
+            user_id (int | None): 未読数を数えるユーザID
+            unread_only (bool): 未読のあるチャットだけを取得するかどうか
 
         Returns:
             dict: {chats: チャット一覧情報, next_cursor: 次のカーソル}
@@ -47,14 +53,15 @@ class ChatService:
             limit=limit,
             keyword=keyword,
             user_id=user_id,
+            unread_only=unread_only,
         )
         
-    async def get_chat_messages(self, chat_uuid: str, cursor: int | None, limit: int) -> dict:
+    async def get_chat_messages(self, chat_uuid: str, cursor: str | None, limit: int) -> dict:
         """Get chat messages
         
         Args:
             chat_uuid (str): チャットUUID
-            cursor (int): 前回取得時のカーソル
+            cursor (str): 前回取得時のカーソル
             limit (int): 取得数
 
         Returns:
@@ -66,6 +73,75 @@ class ChatService:
             limit=limit,
         )
         
+    async def search_chat_messages(
+        self,
+        corporation_uuid: str,
+        keyword: str,
+        cursor: str | None,
+        limit: int,
+        ) -> dict:
+        """Search chat messages
+            企業のチャットメッセージを本文で検索する(新しい順)
+
+        Args:
+            corporation_uuid (str): 企業UUID
+            keyword (str): 検索キーワード(空白区切りの語を全て含むものを探す)
+            cursor (str | None): 前回取得時のカーソル
+            limit (int): 取得数
+
+        Returns:
+            dict: {data: 検索結果, next_cursor: 次のカーソル}
+        """
+        words = terms(keyword)
+        # 本文のインデックスは2文字単位のため、2文字以上の語が1つは必要
+        if not any(len(word) >= 2 for word in words):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="2文字以上のキーワードを指定してください。",
+            )
+        result = await self.repository.search_chat_messages(
+            corporation_uuid=corporation_uuid,
+            words=words,
+            cursor=cursor,
+            limit=limit,
+        )
+        data = [
+            ChatSearchResponse.ChatSearchResponseItem(
+                chat_uuid=message.chat.uuid,
+                uuid=message.uuid,
+                snippet=snippet(message.body, words),
+                send_at=message.send_at,
+                sender=message.sender,
+                user=message.user,
+            )
+            for message in result['messages']
+        ]
+        return {"data": data, "next_cursor": result['next_cursor']}
+
+    async def get_missed_messages(self, chat_uuid: str, last_uuid: str, limit: int) -> List[dict]:
+        """Get missed messages
+            WebSocket再接続時に、最後に受け取ったメッセージより後のメッセージを配信と同じ形式で返す
+
+        Args:
+            chat_uuid (str): チャットUUID
+            last_uuid (str): 最後に受け取ったメッセージUUID
+            limit (int): 取得数
+
+        Returns:
+            List[dict]: 送信内容(古い順)
+        """
+        messages = await self.repository.get_chat_messages_after(chat_uuid, last_uuid, limit)
+        return [
+            ChatShowResponse.ChatShowResponseItem(
+                uuid=message.uuid,
+                body=message.body,
+                send_at=message.send_at,
+                sender=message.sender,
+                user=message.user
+            ).model_dump(mode="json")
+            for message in messages
+        ]
+
     async def user_save_chat_message(
         self,
         chat_uuid: str,
@@ -84,25 +160,13 @@ class ChatService:
         Returns:
             ChatMessages: チャットメッセージ
         """
-        chat = await self.repository.get_chat_by_uuid(chat_uuid)
-        if not chat:
-            corporation = await self.corporation_repository.get_corporation_by_uuid(corporation_uuid)
-            if corporation is None:
-                raise Exception("企業が存在しません。")
-            chat = await self.repository.create_chat(
-                uuid=chat_uuid,
-                corporation_uuid=corporation.id,
-                user_id=user_id,
-            )
-        message = await self.save_chat_message(
-            chat_id=chat.id,
-            sender=ChatConsts.SENDER_USER,
-            user_id=user_id,
+        message = await self.save_room_message(
+            chat_uuid=chat_uuid,
+            corporation_uuid=corporation_uuid,
             body=body,
+            user_id=user_id,
         )
-        chat = await self.repository.get_chat_by_uuid(chat_uuid, user_id)
-        await self.chats_broadcast(chat)
-        await self.room_message_broadcast(message, chat_uuid)
+        await self.message_broadcast(message)
         return message
         
     async def guest_save_chat_message(
@@ -121,63 +185,78 @@ class ChatService:
         Returns:
             ChatMessages: チャットメッセージ
         """
-        chat = await self.repository.get_chat_by_uuid(chat_uuid)
-        # まだチャットが存在しない場合は新規作成(uuidはiframeで先行生成されるためチャットがない場合がある)
-        if not chat:
-            corporation = await self.corporation_repository.get_corporation_by_uuid(corporation_uuid)
-            if corporation is None:
-                raise Exception("企業が存在しません。")
-            chat = await self.repository.create_chat(
-                uuid=chat_uuid,
-                corporation_uuid=corporation.id,
-                user_id=None,
-            )
-        
-        message = await self.save_chat_message(
-            chat_id=chat.id,
-            sender=ChatConsts.SENDER_GUEST,
-            user_id=None,
+        message = await self.save_room_message(
+            chat_uuid=chat_uuid,
+            corporation_uuid=corporation_uuid,
             body=body,
         )
-        chat = await self.repository.get_chat_by_uuid(chat_uuid)
-        await self.chats_broadcast(chat)
-        await self.room_message_broadcast(message, chat_uuid)
+        await self.message_broadcast(message)
         return message
-    
-    async def save_chat_message(
+
+    async def save_room_message(
         self,
-        chat_id: int,
-        sender: int,
-        user_id: int | None,
-        body: str
+        chat_uuid: str,
+        corporation_uuid: str,
+        body: str,
+        user_id: int | None = None,
         ) -> ChatMessages:
-        """Save chat message
-        
+        """Save room message
+            チャットがなければ作成してメッセージを保存する(配信はしない)
+            保存と配信に必要なチャットの取得は1つのトランザクションで行う
+
         Args:
             chat_uuid (str): チャットUUID
-            sender (int): 送信者 1:チャット質問者 2:企業回答者(ユーザー)
-            user_id (int): ユーザID
+            corporation_uuid (str): 企業UUID
             body (str): メッセージ内容
+            user_id (int | None): ユーザID(Noneの場合はゲストの送信)
 
         Returns:
-            ChatMessages: チャットメッセージ
-        """    
-        return await self.repository.save_chat_message(
-            chat_id=chat_id,
-            sender=sender,
+            ChatMessages: チャットメッセージ(chatは一覧配信用のチャット。ユーザーごとの未読数は含まない)
+        """
+        # 送信者はキャッシュしたユーザーから組み立てる
+        user = await self.user_repository.get_user_by_id(user_id) if user_id is not None else None
+        message = await self.repository.send_chat_message(
+            chat_uuid=chat_uuid,
+            corporation_uuid=corporation_uuid,
+            sender=ChatConsts.SENDER_USER if user_id is not None else ChatConsts.SENDER_GUEST,
             user_id=user_id,
             body=body,
+            user=user,
         )
-        
+        if message is None:
+            raise Exception("企業が存在しません。")
+        return message
+
+    async def message_broadcast(self, message: ChatMessages):
+        """Message broadcast
+            保存したメッセージのチャット一覧と部屋の接続への配信をoutboxに積む(配信の完了は待たない)
+
+        Args:
+            message (ChatMessages): save_room_messageで保存したメッセージ
+        """
+        chat = message.chat
+
+        async def deliver():
+            await self.chats_broadcast(chat)
+            await self.room_message_broadcast(message, chat.uuid)
+
+        outbox.put(chat.uuid, deliver)
+    
     async def chats_broadcast(self, chats: Chats, user_id: int | None = None):
         """Chats broadcast
         
         Args:
             chats (Chats): チャット
+            user_id (int | None): 既読状態を反映するユーザID(指定時はそのユーザーの接続にだけ配信する)
         """
         chat = await self.chat_response_item_mapping([chats], user_id)
+        if user_id is None:
+            # 企業全体への配信には、ユーザーごとに異なる既読状態を含めない
+            chat[0].is_read = None
+            chat[0].unread_count = None
         await connection_manager.broadcast(
-            chat[0]
+            chat[0],
+            user_id,
         )
         
     async def room_message_broadcast(self, message: ChatMessages, chat_uuid: str):
@@ -202,37 +281,27 @@ class ChatService:
         """Chat response item mapping
 
         Args:
-            chats (List[Chats]): _description_
-            user_id (int | None): _description_
+            chats (List[Chats]): チャット一覧(get_chat_queryで取得したもの)
+            user_id (int | None): 既読状態を判定したユーザID
 
         Returns:
             List[ChatIndexResponse.ChatIndexResponseItem]
         """
         chats_data = []
-        is_read = True
         for chat in chats:
-            messages = [message for message in chat.messages if message.sender == ChatConsts.SENDER_GUEST]
-            for message in messages:
-                if not message.chat_read:
-                    is_read = False
-                    break
-                if not any(read.user_id == user_id for read in message.chat_read):
-                    is_read = False
-                    break
-                if user_id is None:
-                    is_read = False
-                    break
-                is_read = True
-                break
+            # 最新メッセージと未読数はリポジトリで取得済み(全メッセージは読み込まない)
+            # 未読数を取得していないチャット(全体への配信)では、既読状態はユーザーごとに異なるためnullにする
+            unread_count = chat.unread_count
             item = ChatIndexResponse.ChatIndexResponseItem(
                 uuid=chat.uuid,
                 user_id=chat.user_id,
                 user_name=chat.user.account_name if chat.user_id else None,
                 corporation_uuid=chat.corporation.uuid,
                 corporation_name=chat.corporation.name,
-                latest_message=chat.messages[-1].body,
-                latest_send_at=chat.messages[-1].send_at,
-                is_read=is_read
+                latest_message=chat.latest_message.body,
+                latest_send_at=chat.latest_message.send_at,
+                is_read=unread_count == 0 if unread_count is not None else None,
+                unread_count=unread_count,
             )
             chats_data.append(item)
         return chats_data
@@ -244,11 +313,12 @@ class ChatService:
             chat_uuid (str): チャットUUID
             user_id (int): ユーザID
         """
-        chat = await self.repository.get_chat_by_uuid(chat_uuid)
+        chat = await self.repository.resolve_chat(chat_uuid)
         if not chat:
             raise Exception("チャットが存在しません。")
         await self.repository.read_chat_message(chat.id, user_id)
-        chat = await self.repository.get_chat_by_uuid(chat_uuid)
-        await self.chats_broadcast(chat, user_id)
+        chat = await self.repository.get_chat_by_uuid(chat_uuid, user_id)
+        # メッセージの配信と順序が入れ替わらないよう、同じ部屋のoutboxから配信する
+        outbox.put(chat_uuid, lambda: self.chats_broadcast(chat, user_id))
         return chat
         
\ No newline at end of file